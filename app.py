@@ -1,13 +1,11 @@
 import os
-import logging
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 from sqlalchemy.orm import DeclarativeBase
 from werkzeug.middleware.proxy_fix import ProxyFix
-
-# Set up logging
-logging.basicConfig(level=logging.DEBUG)
+from logging_setup import configure_logging, clear_log_context
+import database
 
 class Base(DeclarativeBase):
     pass
@@ -15,50 +13,119 @@ class Base(DeclarativeBase):
 db = SQLAlchemy(model_class=Base)
 login_manager = LoginManager()
 
-# Create the app
-app = Flask(__name__)
-app.secret_key = os.environ.get("SESSION_SECRET", "dev-secret-key-change-in-production")
-app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
-
 # Initialize Flask-Login
-login_manager.init_app(app)
 login_manager.login_view = 'login'
 login_manager.login_message = 'Please log in to access this page.'
 login_manager.login_message_category = 'info'
 
-# Configure the database - MySQL for XAMPP
-# Default XAMPP: root user with no password, database: virtual_ihc_db
-app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get(
-    "DATABASE_URL", 
-    "mysql+pymysql://root:@localhost/virtual_ihc_db?charset=utf8mb4"
-)
-app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
-    "pool_recycle": 300,
-    "pool_pre_ping": True,
-}
-
-# Configure upload settings
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size 
-
-app.config['UPLOAD_FOLDER'] = os.path.join(app.root_path, 'uploads')
-app.config['GENERATED_FOLDER'] = os.path.join(app.root_path, 'generated')
-
-# Create upload directories if they don't exist
-os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-os.makedirs(app.config['GENERATED_FOLDER'], exist_ok=True)
-os.makedirs('static/uploads', exist_ok=True)
-os.makedirs('static/generated', exist_ok=True)
-
-# Initialize the app with the extension
-db.init_app(app)
-
-with app.app_context():
-    # Import models and routes
+def create_app(config=None):
+    """
+    Create and configure the application
+    Heavy modules (OpenCV, ReportLab, the models) are imported on first use;
+    tables are created with `flask init-db` rather than on import
+    """
+    app = Flask(__name__)
+    app.secret_key = os.environ.get("SESSION_SECRET", "dev-secret-key-change-in-production")
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
+
+    # Configure the database - MySQL for XAMPP
+    # Default XAMPP: root user with no password, database: virtual_ihc_db
+    # DATABASE_MODE=embedded uses a local SQLite file instead (no DB server)
+    if os.environ.get("DATABASE_MODE") == "embedded" and "DATABASE_URL" not in os.environ:
+        default_uri = database.embedded_database_uri(app.instance_path)
+    else:
+        default_uri = "mysql+pymysql://root:@localhost/virtual_ihc_db?charset=utf8mb4"
+    app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL", default_uri)
+
+    # Configure upload settings
+    app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+
+    app.config['UPLOAD_FOLDER'] = os.path.join(app.root_path, 'uploads')
+    app.config['GENERATED_FOLDER'] = os.path.join(app.root_path, 'generated')
+    app.config['SIMILARITY_INDEX_FOLDER'] = os.path.join(app.root_path, 'similarity_index')
+
+    # Decoded images shared between pipeline stages as memory-mapped arrays
+    app.config['ARRAY_STORE_FOLDER'] = os.path.join(app.root_path, 'array_store')
+    app.config['ARRAY_STORE_MAX_BYTES'] = int(os.environ.get('ARRAY_STORE_MAX_MB', '2048')) * 1024 * 1024
+
+    # Stain normalization before conversion: 'macenko', 'reinhard' or empty to disable
+    app.config['STAIN_NORMALIZATION'] = os.environ.get('STAIN_NORMALIZATION', '')
+    app.config['STAIN_PROFILE_FOLDER'] = os.path.join(app.root_path, 'stain_profiles')
+
+    # Generated IHC encoding ('png', lossless 'webp' or 'jpeg' previews), written in the background
+    app.config['IHC_IMAGE_FORMAT'] = os.environ.get('IHC_IMAGE_FORMAT', 'png')
+    app.config['IHC_PNG_COMPRESSION'] = int(os.environ.get('IHC_PNG_COMPRESSION', '3'))
+    app.config['IHC_JPEG_QUALITY'] = int(os.environ.get('IHC_JPEG_QUALITY', '95'))
+    app.config['IMAGE_WRITER_WORKERS'] = int(os.environ.get('IMAGE_WRITER_WORKERS', '2'))
+    app.config['IMAGE_FSYNC_INTERVAL'] = float(os.environ.get('IMAGE_FSYNC_INTERVAL', '1.0'))
+
+    # Completed sessions cached per process for the results/report pages
+    app.config['RESULT_CACHE_SIZE'] = int(os.environ.get('RESULT_CACHE_SIZE', '512'))
+    app.config['RESULT_CACHE_TTL'] = float(os.environ.get('RESULT_CACHE_TTL', '300'))
+
+    # Memory budget shared by all worker processes for concurrent analyses (0
+    # disables it), kept in MEMORY_BUDGET_FILE; uploads wait up to
+    # MEMORY_ADMISSION_TIMEOUT seconds for room before being turned away.
+    # MEMORY_TRACE adds tracemalloc peaks to the per-stage RSS accounting
+    app.config['MEMORY_BUDGET_BYTES'] = int(os.environ.get('MEMORY_BUDGET_MB', '1024')) * 1024 * 1024
+    app.config['MEMORY_BUDGET_FILE'] = os.environ.get('MEMORY_BUDGET_FILE', os.path.join(app.instance_path, 'memory_budget.json'))
+    app.config['MEMORY_ADMISSION_TIMEOUT'] = float(os.environ.get('MEMORY_ADMISSION_TIMEOUT', '30'))
+    app.config['MEMORY_TRACE'] = os.environ.get('MEMORY_TRACE', '0') == '1'
+
+    # Average classifier predictions over flipped/rotated views (test-time augmentation)
+    app.config['CLASSIFIER_TTA'] = os.environ.get('CLASSIFIER_TTA', '0') == '1'
+
+    # Load the models in the master process so forked workers share them
+    app.config['PRELOAD_MODELS'] = os.environ.get('PRELOAD_MODELS', '0') == '1'
+
+    # Logging: base level, per-module overrides ("ml_models=DEBUG,routes=WARNING"),
+    # 1-in-N sampling of DEBUG/INFO records ("routes=10") and 'json' or 'text' output
+    app.config['LOG_LEVEL'] = os.environ.get('LOG_LEVEL', 'INFO')
+    app.config['LOG_LEVELS'] = os.environ.get('LOG_LEVELS', '')
+    app.config['LOG_SAMPLING'] = os.environ.get('LOG_SAMPLING', '')
+    app.config['LOG_FORMAT'] = os.environ.get('LOG_FORMAT', 'json')
+
+    if config:
+        app.config.update(config)
+
+    # WAL and a shared connection pool for SQLite; recycling and pings for MySQL
+    app.config.setdefault("SQLALCHEMY_ENGINE_OPTIONS", database.engine_options(
+        app.config["SQLALCHEMY_DATABASE_URI"], int(os.environ.get("DB_POOL_SIZE", "10"))
+    ))
+
+    configure_logging(
+        level=app.config['LOG_LEVEL'],
+        module_levels=app.config['LOG_LEVELS'],
+        sampling=app.config['LOG_SAMPLING'],
+        json_format=app.config['LOG_FORMAT'] == 'json'
+    )
+    app.teardown_request(clear_log_context)
+
+    # Create upload directories if they don't exist
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    os.makedirs(app.config['GENERATED_FOLDER'], exist_ok=True)
+
+    # Initialize the app with the extensions
+    login_manager.init_app(app)
+    db.init_app(app)
+    database.init_app(app, db)
+
+    # Import models and register routes and CLI commands
     import models
     import routes
-    
-    # Create all tables
-    db.create_all()
+    import cli
+    import queries
+    import memory_budget
+    routes.init_app(app)
+    cli.init_app(app)
+    queries.init_app(app)
+    memory_budget.init_app(app)
+
+    if app.config['PRELOAD_MODELS']:
+        import model_registry
+        model_registry.preload(app)
+
+    return app
 
 @login_manager.user_loader
 def load_user(user_id):
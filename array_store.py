@@ -0,0 +1,124 @@
+import os
+import time
+import uuid
+import logging
+import threading
+from collections import OrderedDict
+import numpy as np
+import storage
+
+logger = logging.getLogger(__name__)
+
+class ArrayStore:
+    """
+    Decoded RGB arrays of a session kept as memory-mapped .npy files
+    Later stages and re-analyses open them read-only without decoding the
+    image again; the least recently used files are evicted once the store
+    grows beyond max_bytes. Sizes and recency are tracked in memory and the
+    directory is walked only on first use and every rescan_interval
+    seconds, to pick up arrays written or removed by other processes
+    """
+
+    SUFFIX = '.npy'
+
+    def __init__(self, directory, max_bytes=2 * 1024 ** 3, rescan_interval=300.0):
+        """Open (or create) the store under directory"""
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.rescan_interval = rescan_interval
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._total = 0
+        self._scanned_at = None
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, session_id, name):
+        """Sharded location of a session's array, next to where its images are stored"""
+        return storage.shard_path(self.directory, f"{session_id}_{name}{self.SUFFIX}", create=False)
+
+    def get(self, session_id, name):
+        """Return the stored array memory-mapped read-only, or None"""
+        path = self.path(session_id, name)
+        try:
+            array = np.load(path, mmap_mode='r')
+        except (FileNotFoundError, ValueError):
+            return None
+        # Recently read arrays are evicted last, here and after the next rescan
+        os.utime(path)
+        with self._lock:
+            if path in self._entries:
+                self._entries.move_to_end(path)
+        return array
+
+    def put(self, session_id, name, array):
+        """Store an array and return it memory-mapped from the store"""
+        path = self.path(session_id, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write to a private name first so readers never see a partial file
+        temporary = f"{path}.{uuid.uuid4().hex}.tmp"
+        mapped = np.lib.format.open_memmap(temporary, mode='w+', dtype=array.dtype, shape=array.shape)
+        mapped[...] = array
+        mapped.flush()
+        del mapped
+        os.replace(temporary, path)
+
+        size = os.path.getsize(path)
+        with self._lock:
+            self._scan_if_due()
+            self._total += size - self._entries.pop(path, 0)
+            self._entries[path] = size
+        self.enforce_budget(keep=path)
+        return np.load(path, mmap_mode='r')
+
+    def load_image(self, session_id, name, image_path, decode):
+        """Read-through: the stored array, or decode(image_path) once and store it"""
+        array = self.get(session_id, name)
+        if array is None:
+            array = self.put(session_id, name, decode(image_path))
+        return array
+
+    def _scan_if_due(self):
+        """Rebuild the size and recency index from the directory when it is stale"""
+        now = time.monotonic()
+        if self._scanned_at is not None and now - self._scanned_at < self.rescan_interval:
+            return
+        entries = []
+        for path in storage.iter_stored_files(self.directory):
+            if not path.endswith(self.SUFFIX):
+                continue
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, path, stat.st_size))
+        self._entries = OrderedDict((path, size) for _, path, size in sorted(entries))
+        self._total = sum(self._entries.values())
+        self._scanned_at = now
+
+    def size(self):
+        """Total bytes currently stored"""
+        with self._lock:
+            self._scan_if_due()
+            return self._total
+
+    def enforce_budget(self, keep=None):
+        """Evict least recently used arrays until the store fits in max_bytes"""
+        with self._lock:
+            self._scan_if_due()
+            evicted = 0
+            for path in list(self._entries):
+                if self._total <= self.max_bytes:
+                    break
+                if path == keep:
+                    continue
+                try:
+                    # Open memory maps stay valid after the file is unlinked
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                self._total -= self._entries.pop(path)
+                evicted += 1
+            if evicted:
+                logger.info("Array store evicted %s arrays, %s bytes in use", evicted, self._total)
+            return evicted
@@ -0,0 +1,409 @@
+#!/usr/bin/env python3
+"""
+Offline batch processing for Virtual IHC Analysis System
+Runs the two-phase pipeline over a directory or manifest of H&E images
+"""
+import os
+import sys
+import csv
+import json
+import uuid
+import shutil
+import argparse
+import logging
+import threading
+from datetime import datetime
+from multiprocessing import Pool
+from multiprocessing.util import Finalize
+
+# Add current directory to Python path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from utils import allowed_file
+from logging_setup import configure_logging, bind_log_context, stop_logging
+from memory_budget import BASE_FOOTPRINT, MemoryBudget, MemoryMeter, estimate_footprint
+import storage
+
+logger = logging.getLogger(__name__)
+
+RESULT_FIELDS = [
+    'input_path', 'session_id', 'ihc_image_path', 'heatmap_image_path', 'converter_version', 'classifier_version',
+    'her2_status', 'confidence',
+    'cancer_grade', 'biomarker_percentage', 'staining_intensity', 'tta_agreement',
+    'positive_cells', 'total_cells', 'stained_area', 'memory_estimate', 'rss_peak', 'status', 'error', 'features'
+]
+
+# Per-process model instances, created once by the pool initializer
+_converter = None
+_classifier = None
+
+def iter_inputs(source):
+    """Yield image paths from a directory tree or a manifest file"""
+    if os.path.isdir(source):
+        for root, dirs, files in os.walk(source):
+            dirs.sort()
+            for name in sorted(files):
+                if allowed_file(name):
+                    yield os.path.join(root, name)
+        return
+
+    base_dir = os.path.dirname(os.path.abspath(source))
+    with open(source, newline='') as handle:
+        if source.endswith('.csv'):
+            rows = (row.get('path') or row.get('input_path') for row in csv.DictReader(handle))
+        else:
+            rows = (line.strip() for line in handle)
+        for path in rows:
+            if not path or path.startswith('#'):
+                continue
+            yield path if os.path.isabs(path) else os.path.join(base_dir, path)
+
+# Numeric result fields, converted back from their CSV text
+INT_FIELDS = {'positive_cells', 'total_cells', 'memory_estimate', 'rss_peak'}
+FLOAT_FIELDS = {'confidence', 'biomarker_percentage', 'tta_agreement', 'stained_area'}
+# Fields stored as JSON text in CSV files
+JSON_FIELDS = {'features'}
+
+def _parse_csv_record(row):
+    record = {}
+    for field, value in row.items():
+        if value == '' or value is None:
+            value = None
+        elif field in INT_FIELDS:
+            value = int(float(value))
+        elif field in FLOAT_FIELDS:
+            value = float(value)
+        elif field in JSON_FIELDS:
+            value = json.loads(value)
+        record[field] = value
+    return record
+
+def iter_completed_records(output_path):
+    """Yield the completed records of an existing results file"""
+    if not os.path.exists(output_path):
+        return
+
+    with open(output_path, newline='') as handle:
+        if output_path.endswith('.jsonl'):
+            for line in handle:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A partially written last line from an interrupted run
+                    continue
+                if record.get('status') == 'completed':
+                    yield record
+        else:
+            for row in csv.DictReader(handle):
+                if row.get('status') == 'completed':
+                    yield _parse_csv_record(row)
+
+def load_completed(output_path):
+    """Return the input paths already recorded in an existing results file"""
+    return {record['input_path'] for record in iter_completed_records(output_path)}
+
+def load_unregistered(output_path, app):
+    """Completed records of an earlier run whose sessions were never registered"""
+    from app import db
+    from models import AnalysisSession
+
+    records = list(iter_completed_records(output_path))
+    registered = set()
+    with app.app_context():
+        session_ids = [record['session_id'] for record in records]
+        for start in range(0, len(session_ids), 500):
+            registered.update(session_id for (session_id,) in db.session.query(AnalysisSession.session_id).filter(
+                AnalysisSession.session_id.in_(session_ids[start:start + 500])))
+    return [record for record in records if record['session_id'] not in registered]
+
+def _configure_logging():
+    """Structured logging configured from the same variables as the web app"""
+    configure_logging(
+        level=os.environ.get('LOG_LEVEL', 'INFO'),
+        module_levels=os.environ.get('LOG_LEVELS', ''),
+        sampling=os.environ.get('LOG_SAMPLING', ''),
+        json_format=os.environ.get('LOG_FORMAT', 'json') == 'json'
+    )
+
+def _init_worker(tta=False, image_format=None):
+    """Create the pipeline models once per worker process"""
+    global _converter, _classifier
+    # The parent's listener thread does not survive the fork; flush queued
+    # records when the worker exits, since atexit does not run there
+    _configure_logging()
+    Finalize(None, stop_logging, exitpriority=10)
+    from ml_models import HEToIHCConverter, CancerClassifier
+    _converter = HEToIHCConverter()
+    if image_format:
+        # Encoding overlaps with classification of the same image
+        from image_writer import ImageWriter
+        _converter.image_writer = ImageWriter(encoding=image_format, workers=1)
+        Finalize(None, _converter.image_writer.flush, exitpriority=10)
+    _classifier = CancerClassifier(tta=tta)
+
+def process_one(task):
+    """Run both pipeline phases for one image"""
+    input_path, output_dir, memory_estimate = task
+    session_id = str(uuid.uuid4())
+    record = {field: None for field in RESULT_FIELDS}
+    record.update(input_path=input_path, session_id=session_id, memory_estimate=memory_estimate)
+    bind_log_context(session_id=session_id, phase='conversion')
+    # One image at a time per worker, so the sampled RSS is this image's alone
+    meter = MemoryMeter()
+
+    try:
+        ihc_image_path = storage.shard_path(output_dir, f"{session_id}_ihc{_converter.output_extension}")
+        with meter.stage('conversion'):
+            ihc_image = _converter.convert(input_path, ihc_image_path)
+        record['ihc_image_path'] = ihc_image_path
+        record['converter_version'] = _converter.version
+
+        bind_log_context(phase='classification')
+        heatmap_path = storage.shard_path(output_dir, f"{session_id}_her2_heatmap.png")
+        with meter.stage('classification'):
+            prediction = _classifier.predict(ihc_image_path, heatmap_path=heatmap_path, image=ihc_image)
+        # Kept for the session's stored features and the similarity index
+        features = prediction.pop('features', None)
+        if features is not None:
+            record['features'] = [float(value) for value in features]
+        record['heatmap_image_path'] = prediction.pop('heatmap_path', None)
+        if _converter.image_writer is not None:
+            _converter.image_writer.wait(ihc_image_path)
+            _converter.image_writer.wait(storage.preview_path(ihc_image_path))
+        record.update(prediction)
+        record['classifier_version'] = _classifier.version
+        record['status'] = 'completed'
+    except Exception as e:
+        logger.error("Batch processing failed for %s: %s", input_path, e)
+        record['status'] = 'failed'
+        record['error'] = str(e)
+
+    if meter.stages:
+        record['rss_peak'] = max(stage['rss_peak'] for stage in meter.stages)
+    return record
+
+class ResultWriter:
+    """Append-only CSV or JSONL results file"""
+
+    def __init__(self, output_path):
+        self.jsonl = output_path.endswith('.jsonl')
+        write_header = not os.path.exists(output_path) or os.path.getsize(output_path) == 0
+        self.handle = open(output_path, 'a', newline='')
+        if not self.jsonl:
+            self.writer = csv.DictWriter(self.handle, fieldnames=RESULT_FIELDS)
+            if write_header:
+                self.writer.writeheader()
+
+    def write(self, record):
+        """Write one record and flush so an interrupted run can resume"""
+        if self.jsonl:
+            self.handle.write(json.dumps(record) + '\n')
+        else:
+            self.writer.writerow({field: json.dumps(value) if field in JSON_FIELDS and value is not None else value
+                                  for field, value in record.items()})
+        self.handle.flush()
+
+    def close(self):
+        self.handle.close()
+
+def _import_file(source_path, folder, filename):
+    """Hard-link (or copy) a file into the app's sharded storage"""
+    target = storage.shard_path(folder, filename)
+    if not os.path.exists(target):
+        try:
+            os.link(source_path, target)
+        except OSError:
+            shutil.copy2(source_path, target)
+    return target
+
+def register_results(records, username, app):
+    """Bulk-register completed results as AnalysisSession, ReportData and SessionFeatures rows"""
+    from app import db
+    from features import FEATURE_VERSION, pack_vector
+    from model_registry import get_similarity_index
+    from models import AnalysisSession, ReportData, SessionFeatures, User
+    from routes import generate_summary, generate_recommendations, generate_technical_notes
+    from werkzeug.utils import secure_filename
+
+    with app.app_context():
+        user = User.query.filter_by(username=username).first()
+        if user is None:
+            raise ValueError(f"Unknown user: {username}")
+
+        now = datetime.utcnow()
+        indexed = []
+        for record in records:
+            session_id = record['session_id']
+            filename = secure_filename(os.path.basename(record['input_path'])) or 'image'
+
+            # Sessions are served from the app's own storage folders
+            he_image_path = _import_file(record['input_path'], app.config['UPLOAD_FOLDER'],
+                                         f"{session_id}_{filename}")
+            ihc_image_path = _import_file(record['ihc_image_path'], app.config['GENERATED_FOLDER'],
+                                          os.path.basename(record['ihc_image_path']))
+            preview = storage.preview_path(record['ihc_image_path'])
+            if os.path.exists(preview):
+                _import_file(preview, app.config['GENERATED_FOLDER'], os.path.basename(preview))
+
+            analysis_session = AnalysisSession()
+            analysis_session.session_id = session_id
+            analysis_session.user_id = user.id
+            analysis_session.original_filename = filename
+            analysis_session.he_image_path = he_image_path
+            analysis_session.ihc_image_path = ihc_image_path
+            if record.get('heatmap_image_path'):
+                analysis_session.heatmap_image_path = _import_file(record['heatmap_image_path'],
+                                                                   app.config['GENERATED_FOLDER'],
+                                                                   os.path.basename(record['heatmap_image_path']))
+            analysis_session.converter_version = record['converter_version']
+            analysis_session.memory_estimate = record.get('memory_estimate')
+            classification_result = analysis_session.apply_prediction(record, record['classifier_version'])
+            db.session.add(classification_result)
+            analysis_session.processing_status = 'completed'
+            analysis_session.created_at = now
+            analysis_session.completed_at = now
+            db.session.add(analysis_session)
+
+            report_data = ReportData()
+            report_data.session_id = session_id
+            report_data.report_type = 'research'
+            report_data.summary = generate_summary(analysis_session)
+            report_data.recommendations = generate_recommendations(analysis_session)
+            report_data.technical_notes = generate_technical_notes(analysis_session)
+            report_data.positive_cell_count = record['positive_cells']
+            report_data.total_cell_count = record['total_cells']
+            report_data.stained_area_percentage = record['stained_area']
+            db.session.add(report_data)
+            classification_result.copy_report(report_data)
+
+            features = record.get('features')
+            if features is not None:
+                session_features = SessionFeatures()
+                session_features.session_id = session_id
+                session_features.feature_version = FEATURE_VERSION
+                session_features.dimension = len(features)
+                session_features.vector = pack_vector(features)
+                db.session.add(session_features)
+                indexed.append((analysis_session, features))
+
+        db.session.commit()
+        logger.info("Registered %s batch results for %s", len(records), username)
+
+        # Make the registered sessions findable by similar-case search
+        if indexed:
+            try:
+                get_similarity_index().add_batch([analysis_session.id for analysis_session, _ in indexed],
+                                                 [features for _, features in indexed])
+            except Exception as e:
+                logger.error("Similarity index update failed: %s", e)
+
+def _admitted_tasks(paths, output_dir, budget, stop):
+    """
+    Yield tasks as their expected footprint fits in the memory budget
+    The pool pulls tasks from this generator on its own thread, so a large
+    image waits here until results of earlier ones release their share.
+    Setting stop ends the wait, so the pool can shut down on errors
+    """
+    for path in paths:
+        try:
+            memory_estimate = estimate_footprint(path)
+        except Exception as e:
+            # The worker reports the unreadable image; reserve the fixed cost only
+            logger.warning("Could not read image header of %s: %s", path, e)
+            memory_estimate = BASE_FOOTPRINT
+        while not budget.acquire(memory_estimate, timeout=0.5):
+            if stop.is_set():
+                return
+        if stop.is_set():
+            budget.release(memory_estimate)
+            return
+        yield path, output_dir, memory_estimate
+
+def _dispose_engine(app):
+    from app import db
+    with app.app_context():
+        db.engine.dispose()
+
+def run_batch(source, output_dir, results_path, workers=1, register_user=None,
+              register_batch_size=50, tta=False, image_format=None, memory_budget_bytes=0):
+    """Process every pending image and stream results to the results file"""
+    os.makedirs(output_dir, exist_ok=True)
+    completed = load_completed(results_path)
+    paths = [path for path in iter_inputs(source) if path not in completed]
+    logger.info("Batch: %s already completed, %s pending", len(completed), len(paths))
+    # Shared by all workers: images in flight together must fit in it
+    budget = MemoryBudget(memory_budget_bytes)
+    stop = threading.Event()
+
+    app = None
+    if register_user:
+        from app import create_app
+        app = create_app()
+        # Results written but not registered when an earlier run was interrupted
+        unregistered = load_unregistered(results_path, app)
+        for start in range(0, len(unregistered), register_batch_size):
+            register_results(unregistered[start:start + register_batch_size], register_user, app)
+        if unregistered:
+            logger.info("Registered %s results left over from an earlier run", len(unregistered))
+        # Forked workers must not inherit open database connections
+        _dispose_engine(app)
+
+    writer = ResultWriter(results_path)
+    pending_registration = []
+    counts = {'completed': 0, 'failed': 0}
+    try:
+        with Pool(processes=workers, initializer=_init_worker, initargs=(tta, image_format)) as pool:
+            try:
+                for record in pool.imap_unordered(process_one, _admitted_tasks(paths, output_dir, budget, stop)):
+                    budget.release(record['memory_estimate'])
+                    writer.write(record)
+                    counts[record['status']] += 1
+                    if register_user and record['status'] == 'completed':
+                        pending_registration.append(record)
+                        if len(pending_registration) >= register_batch_size:
+                            register_results(pending_registration, register_user, app)
+                            pending_registration = []
+            finally:
+                # Let the task handler leave a pending admission so the pool can terminate
+                stop.set()
+        # After an interruption, unregistered results are picked up on resume
+        if pending_registration:
+            register_results(pending_registration, register_user, app)
+    finally:
+        writer.close()
+        if app is not None:
+            _dispose_engine(app)
+
+    return counts
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Batch-process H&E images through the Virtual IHC pipeline')
+    parser.add_argument('source', help='Directory of H&E images or a manifest (.txt/.csv with a path column)')
+    parser.add_argument('-o', '--output-dir', default='batch_output', help='Directory for generated IHC images')
+    parser.add_argument('-r', '--results', default=None,
+                        help='Results file (.csv or .jsonl); re-running resumes from it')
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count() or 1,
+                        help='Number of worker processes')
+    parser.add_argument('--register-user', default=None,
+                        help='Also store results as analysis sessions owned by this username')
+    parser.add_argument('--tta', action='store_true',
+                        help='Average predictions over flipped/rotated views and report their agreement')
+    parser.add_argument('--image-format', choices=['png', 'webp', 'jpeg'], default=None,
+                        help='Encode generated IHC images in the background in this format')
+    parser.add_argument('--memory-budget-mb', type=int, default=int(os.environ.get('MEMORY_BUDGET_MB', '0')),
+                        help='Start an image only when the expected memory of all images in flight fits (0: no limit)')
+    args = parser.parse_args(argv)
+
+    _configure_logging()
+    results_path = args.results or os.path.join(args.output_dir, 'results.csv')
+    counts = run_batch(args.source, args.output_dir, results_path,
+                       workers=args.workers, register_user=args.register_user, tta=args.tta,
+                       image_format=args.image_format, memory_budget_bytes=args.memory_budget_mb * 1024 * 1024)
+    print(f"Completed: {counts['completed']}, failed: {counts['failed']}")
+    print(f"Results written to {results_path}")
+
+if __name__ == '__main__':
+    main()
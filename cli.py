@@ -0,0 +1,194 @@
+import os
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from app import db
+from models import AnalysisSession, SessionFeatures
+import storage
+import database
+
+# Commands are added to the application's `flask` CLI by init_app
+_commands = []
+
+def command(name):
+    """Declare a `flask <name>` command that runs inside the app context"""
+    def decorator(function):
+        cli_command = click.command(name)(with_appcontext(function))
+        _commands.append(cli_command)
+        return cli_command
+    return decorator
+
+def init_app(app):
+    """Register all commands on the application"""
+    for cli_command in _commands:
+        app.cli.add_command(cli_command)
+
+@command('init-db')
+def init_db_command():
+    """Create all database tables and any missing indexes"""
+    created = database.ensure_indexes(db.engine, db.metadata)
+    click.echo(f"Database tables created ({created} missing indexes added)")
+
+@command('migrate-storage')
+@click.option('--dry-run', is_flag=True, help='Only list the files that would move')
+def migrate_storage_command(dry_run):
+    """Move flat uploads/ and generated/ files into the sharded layout"""
+    for folder in (current_app.config['UPLOAD_FOLDER'], current_app.config['GENERATED_FOLDER']):
+        moved = storage.migrate_flat_layout(folder, dry_run=dry_run)
+        click.echo(f"{folder}: {len(moved)} files {'to move' if dry_run else 'moved'}")
+
+    if dry_run:
+        return
+
+    # Stored paths point at the old flat locations
+    updated = 0
+    for session in AnalysisSession.query.all():
+        for attribute, folder in (('he_image_path', current_app.config['UPLOAD_FOLDER']),
+                                  ('ihc_image_path', current_app.config['GENERATED_FOLDER'])):
+            path = getattr(session, attribute)
+            if path:
+                resolved = storage.resolve_path(folder, path)
+                if resolved != path:
+                    setattr(session, attribute, resolved)
+                    updated += 1
+    db.session.commit()
+    click.echo(f"Updated {updated} stored image paths")
+
+@command('gc-storage')
+@click.option('--report-max-age', default=24.0, show_default=True,
+              help='Hours after which cached report PDFs are deleted')
+@click.option('--min-age', default=1.0, show_default=True,
+              help='Hours a file without a session must exist before it is deleted as orphaned')
+@click.option('--dry-run', is_flag=True, help='Only list the files that would change')
+def gc_storage_command(report_max_age, min_age, dry_run):
+    """Delete orphaned files, expire cached PDFs and hard-link duplicates"""
+    known_session_ids = {row.session_id for row in
+                         db.session.query(AnalysisSession.session_id)}
+    result = storage.collect_garbage(
+        current_app.config['UPLOAD_FOLDER'],
+        current_app.config['GENERATED_FOLDER'],
+        known_session_ids,
+        report_max_age_seconds=report_max_age * 3600,
+        orphan_min_age_seconds=min_age * 3600,
+        dry_run=dry_run
+    )
+    # Decoded arrays of deleted sessions; the store evicts the rest by size
+    array_orphans = storage.find_orphans([current_app.config['ARRAY_STORE_FOLDER']], known_session_ids,
+                                         min_age_seconds=min_age * 3600)
+    if not dry_run:
+        for path in array_orphans:
+            os.remove(path)
+
+    prefix = 'Would remove' if dry_run else 'Removed'
+    click.echo(f"{prefix} {len(result['orphans'])} orphaned files")
+    click.echo(f"{prefix} {len(array_orphans)} orphaned arrays")
+    click.echo(f"{prefix} {len(result['expired_reports'])} expired report PDFs")
+    click.echo(f"{'Would link' if dry_run else 'Linked'} {len(result['linked_duplicates'])} duplicate files")
+
+@command('reclassify')
+@click.option('--batch-size', default=50, show_default=True, help='Sessions committed per batch')
+@click.option('--limit', default=None, type=int, help='Stop after this many sessions (resume later)')
+def reclassify_command(batch_size, limit):
+    """Re-run Phase 2 for sessions classified by an older classifier version"""
+    from ml_models import CancerClassifier
+    from reclassify import run_reclassification
+
+    classifier = CancerClassifier()
+    job = run_reclassification(classifier, batch_size=batch_size, limit=limit)
+    click.echo(f"Job {job.id} ({job.classifier_version}): {job.status}, "
+               f"{job.processed_sessions}/{job.total_sessions} re-classified, "
+               f"{job.failed_sessions} failed")
+
+@command('rebuild-similarity-index')
+def rebuild_similarity_index_command():
+    """Rebuild the similar-case index from stored session feature vectors"""
+    from model_registry import get_similarity_index
+    from features import FEATURE_VERSION, unpack_vector
+
+    similarity_index = get_similarity_index()
+    similarity_index.clear()
+    rows = db.session.query(AnalysisSession.id, SessionFeatures.vector).join(
+        SessionFeatures, SessionFeatures.session_id == AnalysisSession.session_id
+    ).filter(
+        AnalysisSession.processing_status == 'completed',
+        SessionFeatures.feature_version == FEATURE_VERSION
+    ).order_by(AnalysisSession.id).yield_per(1000)
+
+    added = 0
+    session_pks, vectors = [], []
+    for session_pk, vector in rows:
+        session_pks.append(session_pk)
+        vectors.append(unpack_vector(vector))
+        if len(session_pks) == 1000:
+            similarity_index.add_batch(session_pks, vectors)
+            added += len(session_pks)
+            session_pks, vectors = [], []
+    if session_pks:
+        similarity_index.add_batch(session_pks, vectors)
+        added += len(session_pks)
+    if added:
+        similarity_index.train()
+    click.echo(f"Indexed {added} sessions")
+
+@command('fit-stain-profile')
+@click.argument('name')
+@click.argument('image_path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--thumbnail-size', default=2048, show_default=True,
+              help='Longest side the image is reduced to before estimation')
+def fit_stain_profile_command(name, image_path, thumbnail_size):
+    """Estimate and cache stain statistics for a lab/scanner (use NAME "reference" for the target)"""
+    import cv2
+    from stain_normalization import StainNormalizer
+
+    method = current_app.config['STAIN_NORMALIZATION'] or 'macenko'
+    image = cv2.imread(image_path)
+    if image is None:
+        raise click.ClickException(f"Could not load image from {image_path}")
+    image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+    # Estimate from a thumbnail; stain statistics do not need full resolution
+    scale = thumbnail_size / float(max(image.shape[:2]))
+    if scale < 1.0:
+        image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+    StainNormalizer(method, current_app.config['STAIN_PROFILE_FOLDER']).fit_profile(name, image)
+    click.echo(f"Saved {method} stain profile '{name}'")
+
+@command('memory-report')
+@click.option('--limit', default=1000, show_default=True, help='Most recent sessions to summarise')
+def memory_report_command(limit):
+    """Summarise per-stage peak memory and compare it with the admission estimates"""
+    from sqlalchemy import func
+    from models import StageMemory
+
+    recent = db.session.query(AnalysisSession.session_id).filter(
+        AnalysisSession.memory_estimate.isnot(None)
+    ).order_by(AnalysisSession.id.desc()).limit(limit).subquery()
+    growth = StageMemory.rss_peak - StageMemory.rss_start
+    rows = db.session.query(
+        StageMemory.stage,
+        func.count(StageMemory.id),
+        func.avg(StageMemory.seconds),
+        func.avg(growth),
+        func.max(growth),
+        func.max(StageMemory.traced_peak)
+    ).filter(StageMemory.session_id.in_(db.session.query(recent.c.session_id))).group_by(StageMemory.stage).all()
+
+    mib = 1024 * 1024
+    for stage, count, seconds, mean_growth, max_growth, traced_peak in rows:
+        traced = f"{traced_peak / mib:.1f} MiB" if traced_peak is not None else 'n/a'
+        click.echo(f"{stage}: {count} runs, {seconds:.2f}s avg, RSS growth {mean_growth / mib:.1f} MiB avg, "
+                   f"{max_growth / mib:.1f} MiB max, traced peak {traced} max")
+
+    # Observed growth over a whole analysis against the estimate it was admitted with
+    per_session = db.session.query(
+        AnalysisSession.memory_estimate,
+        func.max(StageMemory.rss_peak) - func.min(StageMemory.rss_start)
+    ).join(StageMemory, StageMemory.session_id == AnalysisSession.session_id).filter(
+        AnalysisSession.session_id.in_(db.session.query(recent.c.session_id)),
+        StageMemory.stage != 'report_pdf'
+    ).group_by(AnalysisSession.session_id, AnalysisSession.memory_estimate).all()
+    ratios = [observed / estimate for estimate, observed in per_session if estimate]
+    if ratios:
+        click.echo(f"Observed/estimated peak: {sum(ratios) / len(ratios):.2f} avg, {max(ratios):.2f} max "
+                   f"over {len(ratios)} sessions")
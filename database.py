@@ -0,0 +1,93 @@
+import os
+import logging
+from sqlalchemy import create_engine, event, inspect
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool, StaticPool
+
+logger = logging.getLogger(__name__)
+
+# Applied to every new SQLite connection
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',      # readers never block the single writer
+    'synchronous': 'NORMAL',    # durable at checkpoints; safe with WAL
+    'cache_size': -64000,       # 64 MB page cache per connection
+    'temp_store': 'MEMORY',
+    'foreign_keys': 'ON',
+    'busy_timeout': 10000       # ms to wait for the write lock
+}
+
+def is_sqlite(uri):
+    return uri.startswith('sqlite')
+
+def is_memory_sqlite(uri):
+    """In-memory SQLite (sqlite://, sqlite:///:memory:), as used by tests"""
+    if not is_sqlite(uri):
+        return False
+    database = make_url(uri).database
+    return not database or database == ':memory:' or 'mode=memory' in uri
+
+def embedded_database_uri(instance_path):
+    """SQLite database file used in embedded mode"""
+    os.makedirs(instance_path, exist_ok=True)
+    return f"sqlite:///{os.path.join(instance_path, 'virtual_ihc.db')}"
+
+def engine_options(uri, pool_size=10):
+    """SQLAlchemy engine options tuned for the database behind uri"""
+    if is_memory_sqlite(uri):
+        # One connection holds the whole database, so it cannot be pooled
+        return {
+            'connect_args': {'check_same_thread': False},
+            'poolclass': StaticPool,
+        }
+    if is_sqlite(uri):
+        return {
+            # Connections are shared between request threads through the pool
+            'connect_args': {'check_same_thread': False, 'timeout': 30},
+            'poolclass': QueuePool,
+            'pool_size': pool_size,
+            'max_overflow': pool_size,
+        }
+    return {
+        'pool_recycle': 300,
+        'pool_pre_ping': True,
+    }
+
+def _apply_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    # WAL needs a database file; in-memory databases keep their own journal
+    in_memory = cursor.execute("PRAGMA database_list").fetchone()[2] == ''
+    for name, value in SQLITE_PRAGMAS.items():
+        if in_memory and name == 'journal_mode':
+            continue
+        cursor.execute(f"PRAGMA {name}={value}")
+    cursor.close()
+
+def configure_engine(engine):
+    """Register the SQLite pragmas on an engine (no-op for other databases)"""
+    if engine.dialect.name == 'sqlite' and not event.contains(engine, 'connect', _apply_pragmas):
+        event.listen(engine, 'connect', _apply_pragmas)
+    return engine
+
+def create_configured_engine(uri):
+    """Standalone engine with the same tuning as the application's"""
+    return configure_engine(create_engine(uri, **engine_options(uri)))
+
+def ensure_indexes(engine, metadata):
+    """Create tables and any declared indexes missing from an existing database"""
+    metadata.create_all(engine)
+    inspector = inspect(engine)
+    created = 0
+    for table in metadata.sorted_tables:
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(engine)
+                created += 1
+    if created:
+        logger.info("Created %s missing indexes", created)
+    return created
+
+def init_app(app, db):
+    """Apply SQLite pragmas to the application's engine"""
+    with app.app_context():
+        configure_engine(db.engine)
@@ -0,0 +1,165 @@
+import numpy as np
+from quantification import color_deconvolution
+
+# Bump whenever FEATURE_NAMES or their computation change
+FEATURE_VERSION = 'texture-1'
+
+GRAY_WEIGHTS = np.array([0.299, 0.587, 0.114], dtype=np.float32)
+
+# Gray levels used for the co-occurrence matrices
+GLCM_LEVELS = 16
+
+# Pixel offsets (dy, dx) for 0, 45, 90 and 135 degrees at distance 1
+GLCM_OFFSETS = [(0, 1), (-1, 1), (1, 0), (1, 1)]
+
+FEATURE_NAMES = [
+    'mean_intensity', 'std_intensity', 'skewness', 'p10_intensity', 'p50_intensity', 'p90_intensity',
+    'entropy',
+    'glcm_contrast', 'glcm_dissimilarity', 'glcm_homogeneity', 'glcm_energy', 'glcm_correlation',
+    'mean_red', 'mean_green', 'mean_blue',
+    'dab_mean', 'dab_std', 'dab_p90', 'dab_positive_fraction'
+]
+
+def _tile_starts(length, tile):
+    """Tile offsets along one axis, with a final tile ending exactly at length"""
+    starts = list(range(0, length - tile + 1, tile))
+    if starts[-1] + tile < length:
+        starts.append(length - tile)
+    return starts
+
+class FeatureExtractor:
+    """
+    Computes intensity, entropy, GLCM texture and DAB-channel features
+    for a whole (N, H, W, 3) uint8 batch with vectorized histograms
+    """
+
+    def __init__(self, dab_threshold=0.15, tile_size=512, batch_size=32):
+        """Initialize the DAB positivity threshold and tiling for large images"""
+        self.dab_threshold = dab_threshold
+        self.tile_size = tile_size
+        self.batch_size = batch_size
+        levels = np.arange(GLCM_LEVELS, dtype=np.float64)
+        self._glcm_i, self._glcm_j = np.meshgrid(levels, levels, indexing='ij')
+
+    def extract_batch(self, images):
+        """Return an (N, len(FEATURE_NAMES)) float32 array for a uint8 image batch"""
+        images = np.asarray(images)
+        if images.ndim == 3:
+            images = images[np.newaxis]
+        count = images.shape[0]
+
+        gray = np.rint(images @ GRAY_WEIGHTS).astype(np.uint8)
+        flat_gray = gray.reshape(count, -1)
+
+        # One bincount yields the 256-bin histogram of every image
+        offsets = (np.arange(count) * 256)[:, np.newaxis]
+        hist = np.bincount((flat_gray + offsets).ravel(), minlength=count * 256).reshape(count, 256)
+
+        intensity = self._histogram_statistics(hist)
+        texture = self._glcm_features(gray)
+        color = images.reshape(count, -1, 3).mean(axis=1)
+        dab = self._dab_statistics(images)
+
+        return np.hstack([intensity, texture, color, dab]).astype(np.float32)
+
+    def extract_stream(self, tiles):
+        """Yield feature rows for an iterable of equally sized tiles, batching internally"""
+        batch = []
+        for tile in tiles:
+            batch.append(tile)
+            if len(batch) == self.batch_size:
+                yield from self.extract_batch(np.stack(batch))
+                batch = []
+        if batch:
+            yield from self.extract_batch(np.stack(batch))
+
+    def extract_image(self, image):
+        """Return one feature vector for an image, averaging tiles for large images"""
+        height, width = image.shape[:2]
+        if height <= self.tile_size and width <= self.tile_size:
+            return self.extract_batch(image[np.newaxis])[0]
+
+        # Equally sized tiles covering the whole image; the last row and column
+        # are aligned to the far edge, overlapping their neighbours
+        tile_height, tile_width = min(self.tile_size, height), min(self.tile_size, width)
+        tiles = (image[y:y + tile_height, x:x + tile_width]
+                 for y in _tile_starts(height, tile_height)
+                 for x in _tile_starts(width, tile_width))
+        return np.mean(list(self.extract_stream(tiles)), axis=0).astype(np.float32)
+
+    def as_dict(self, vector):
+        """Map a feature vector to feature names"""
+        return {name: float(value) for name, value in zip(FEATURE_NAMES, vector)}
+
+    def _histogram_statistics(self, hist):
+        """Mean, std, skewness, percentiles and entropy from per-image histograms"""
+        levels = np.arange(256, dtype=np.float64)
+        probabilities = hist / hist.sum(axis=1, keepdims=True)
+
+        mean = probabilities @ levels
+        centered = levels[np.newaxis, :] - mean[:, np.newaxis]
+        variance = (probabilities * centered ** 2).sum(axis=1)
+        std = np.sqrt(variance)
+        skewness = (probabilities * centered ** 3).sum(axis=1) / np.maximum(std ** 3, 1e-10)
+
+        cumulative = np.cumsum(probabilities, axis=1)
+        percentiles = [np.argmax(cumulative >= q, axis=1) for q in (0.1, 0.5, 0.9)]
+
+        entropy = -(probabilities * np.log2(probabilities + 1e-10)).sum(axis=1)
+
+        return np.column_stack([mean, std, skewness] + percentiles + [entropy])
+
+    def _glcm_features(self, gray):
+        """Haralick features from symmetric co-occurrence matrices averaged over four angles"""
+        count, height, width = gray.shape
+        quantized = (gray.astype(np.int64) * GLCM_LEVELS) // 256
+        offsets = (np.arange(count) * GLCM_LEVELS * GLCM_LEVELS)[:, np.newaxis, np.newaxis]
+
+        glcm = np.zeros(count * GLCM_LEVELS * GLCM_LEVELS, dtype=np.float64)
+        for dy, dx in GLCM_OFFSETS:
+            rows = slice(max(0, -dy), height - max(0, dy))
+            cols = slice(max(0, -dx), width - max(0, dx))
+            shifted_rows = slice(max(0, dy), height - max(0, -dy))
+            shifted_cols = slice(max(0, dx), width - max(0, -dx))
+            pairs = (quantized[:, rows, cols] * GLCM_LEVELS
+                     + quantized[:, shifted_rows, shifted_cols] + offsets)
+            glcm += np.bincount(pairs.ravel(), minlength=glcm.size)
+
+        glcm = glcm.reshape(count, GLCM_LEVELS, GLCM_LEVELS)
+        glcm = glcm + glcm.transpose(0, 2, 1)
+        glcm /= np.maximum(glcm.sum(axis=(1, 2), keepdims=True), 1e-10)
+
+        i, j = self._glcm_i, self._glcm_j
+        difference = i - j
+        contrast = (glcm * difference ** 2).sum(axis=(1, 2))
+        dissimilarity = (glcm * np.abs(difference)).sum(axis=(1, 2))
+        homogeneity = (glcm / (1.0 + difference ** 2)).sum(axis=(1, 2))
+        energy = np.sqrt((glcm ** 2).sum(axis=(1, 2)))
+
+        mean_i = (glcm * i).sum(axis=(1, 2))
+        mean_j = (glcm * j).sum(axis=(1, 2))
+        std_i = np.sqrt((glcm * (i - mean_i[:, None, None]) ** 2).sum(axis=(1, 2)))
+        std_j = np.sqrt((glcm * (j - mean_j[:, None, None]) ** 2).sum(axis=(1, 2)))
+        covariance = (glcm * (i - mean_i[:, None, None]) * (j - mean_j[:, None, None])).sum(axis=(1, 2))
+        correlation = covariance / np.maximum(std_i * std_j, 1e-10)
+
+        return np.column_stack([contrast, dissimilarity, homogeneity, energy, correlation])
+
+    def _dab_statistics(self, images):
+        """Mean, std, 90th percentile and positive fraction of the DAB concentration"""
+        count = images.shape[0]
+        dab = color_deconvolution(images)[..., 1].reshape(count, -1)
+        return np.column_stack([
+            dab.mean(axis=1),
+            dab.std(axis=1),
+            np.percentile(dab, 90, axis=1),
+            (dab > self.dab_threshold).mean(axis=1)
+        ])
+
+def pack_vector(vector):
+    """Serialize a feature vector for storage"""
+    return np.asarray(vector, dtype=np.float32).tobytes()
+
+def unpack_vector(blob):
+    """Deserialize a stored feature vector"""
+    return np.frombuffer(blob, dtype=np.float32)
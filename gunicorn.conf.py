@@ -0,0 +1,9 @@
+import os
+
+bind = os.environ.get('BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('WEB_CONCURRENCY', '2'))
+timeout = 120
+
+# Preload mode: the master imports main:app, which loads the models once
+# (PRELOAD_MODELS=1); forked workers then share them copy-on-write
+preload_app = os.environ.get('PRELOAD_MODELS', '0') == '1'
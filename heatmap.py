@@ -0,0 +1,35 @@
+import logging
+import numpy as np
+import cv2
+
+logger = logging.getLogger(__name__)
+
+def render_overlay(image, scores, max_size=512, alpha=0.45, colormap=cv2.COLORMAP_JET):
+    """
+    Blend a tile score grid onto a thumbnail of an RGB uint8 image
+    scores is a (rows, cols) array in [0, 1]; NaN tiles (background) stay uncovered
+    """
+    height, width = image.shape[:2]
+    scale = min(1.0, max_size / max(height, width))
+    size = (max(1, int(round(width * scale))), max(1, int(round(height * scale))))
+    thumbnail = cv2.resize(image, size, interpolation=cv2.INTER_AREA) if scale < 1.0 else image
+
+    valid = np.isfinite(scores)
+    grid = np.where(valid, scores, 0.0).astype(np.float32)
+
+    # Upsample the grid and its mask smoothly to thumbnail resolution
+    levels = cv2.resize(np.rint(grid * 255).astype(np.uint8), size, interpolation=cv2.INTER_LINEAR)
+    coverage = cv2.resize(valid.astype(np.float32), size, interpolation=cv2.INTER_LINEAR)
+    colors = cv2.cvtColor(cv2.applyColorMap(levels, colormap), cv2.COLOR_BGR2RGB)
+
+    weight = (alpha * coverage)[:, :, np.newaxis]
+    blended = thumbnail.astype(np.float32) * (1.0 - weight) + colors.astype(np.float32) * weight
+    return np.clip(blended, 0, 255).astype(np.uint8)
+
+def save_overlay(image, scores, output_path, **options):
+    """Render the heatmap overlay and write it as PNG"""
+    overlay = render_overlay(image, scores, **options)
+    if not cv2.imwrite(output_path, cv2.cvtColor(overlay, cv2.COLOR_RGB2BGR)):
+        raise IOError(f"Could not write heatmap to {output_path}")
+    logger.info("HER2 heatmap saved to %s", output_path)
+    return output_path
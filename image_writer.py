@@ -0,0 +1,174 @@
+import os
+import uuid
+import atexit
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+
+logger = logging.getLogger(__name__)
+
+# File extension per output encoding
+ENCODINGS = {
+    'png': '.png',
+    'webp': '.webp',   # lossless WebP
+    'jpeg': '.jpg'     # high-quality JPEG, for previews
+}
+# Encodings that can hold the master copy later stages re-read
+LOSSLESS = ('png', 'webp')
+
+class ImageWriter:
+    """
+    Encodes generated images and writes them on a background thread pool
+    Masters are always lossless; with the 'jpeg' encoding they are written
+    as PNG and a JPEG preview is written next to them. Files are written to
+    a temporary name and renamed into place; their fsyncs are batched and
+    issued every fsync_interval seconds instead of once per file on the
+    request path
+    """
+
+    def __init__(self, encoding='png', png_compression=3, jpeg_quality=95,
+                 workers=2, fsync_interval=1.0):
+        """Initialize the output encoding and the writer pool"""
+        if encoding not in ENCODINGS:
+            raise ValueError(f"Unknown image encoding: {encoding}")
+        self.encoding = encoding
+        self.png_compression = png_compression
+        self.jpeg_quality = jpeg_quality
+        self.workers = workers
+        self.fsync_interval = fsync_interval
+
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._unsynced = []
+        self._executor = None
+        self._flusher = None
+        self._stop = threading.Event()
+        self._pid = None
+        atexit.register(self.flush)
+
+    @property
+    def master_encoding(self):
+        return self.encoding if self.encoding in LOSSLESS else 'png'
+
+    @property
+    def extension(self):
+        """File extension of master images"""
+        return ENCODINGS[self.master_encoding]
+
+    @property
+    def writes_preview(self):
+        return self.encoding == 'jpeg'
+
+    def _params(self, encoding):
+        if encoding == 'png':
+            return [cv2.IMWRITE_PNG_COMPRESSION, self.png_compression]
+        if encoding == 'webp':
+            # Quality above 100 selects lossless WebP
+            return [cv2.IMWRITE_WEBP_QUALITY, 101]
+        return [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality]
+
+    def encode(self, image, encoding=None):
+        """Encode an RGB uint8 image to bytes, in the master format by default"""
+        encoding = encoding or self.master_encoding
+        ok, encoded = cv2.imencode(ENCODINGS[encoding], cv2.cvtColor(image, cv2.COLOR_RGB2BGR),
+                                   self._params(encoding))
+        if not ok:
+            raise IOError(f"Could not encode image as {encoding}")
+        return encoded.tobytes()
+
+    def write(self, image, output_path, encoding=None):
+        """Encode and write an image on the calling thread; its fsync is batched"""
+        data = self.encode(image, encoding)
+        temporary = f"{output_path}.{uuid.uuid4().hex}.tmp"
+        with open(temporary, 'wb') as handle:
+            handle.write(data)
+        os.replace(temporary, output_path)
+        with self._lock:
+            self._unsynced.append(output_path)
+        return output_path
+
+    def _ensure_started(self):
+        """Create the pool and fsync thread, again in a forked worker process"""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='image-writer')
+            self._pending = {}
+            self._stop = threading.Event()
+            self._flusher = threading.Thread(target=self._fsync_loop, name='image-fsync', daemon=True)
+            self._flusher.start()
+            self._pid = os.getpid()
+
+    def submit(self, image, output_path, encoding=None):
+        """Queue an image for encoding and writing; returns a Future"""
+        if self.workers <= 0:
+            self.write(image, output_path, encoding)
+            return None
+        self._ensure_started()
+        future = self._executor.submit(self.write, image, output_path, encoding)
+        with self._lock:
+            self._pending[output_path] = future
+        future.add_done_callback(lambda done: self._forget(output_path, done))
+        return future
+
+    def _forget(self, output_path, future):
+        if future.exception() is not None:
+            # Failed writes stay pending so that wait() reports the error
+            logger.error("Writing %s failed: %s", output_path, future.exception())
+            return
+        with self._lock:
+            if self._pending.get(output_path) is future:
+                del self._pending[output_path]
+
+    def wait(self, output_path, timeout=None):
+        """Block until a queued write of output_path (if any) has finished; raises if it failed"""
+        with self._lock:
+            future = self._pending.get(output_path)
+        if future is None:
+            return
+        if future.done():
+            with self._lock:
+                if self._pending.get(output_path) is future:
+                    del self._pending[output_path]
+        future.result(timeout=timeout)
+
+    def _fsync_loop(self):
+        while not self._stop.wait(self.fsync_interval):
+            self.sync()
+
+    def sync(self):
+        """fsync every file written since the last call, then their directories once each"""
+        with self._lock:
+            paths, self._unsynced = self._unsynced, []
+        directories = set()
+        for path in paths:
+            try:
+                descriptor = os.open(path, os.O_RDONLY)
+            except FileNotFoundError:
+                continue
+            try:
+                os.fsync(descriptor)
+            finally:
+                os.close(descriptor)
+            directories.add(os.path.dirname(path))
+        for directory in directories:
+            descriptor = os.open(directory, os.O_RDONLY)
+            try:
+                os.fsync(descriptor)
+            finally:
+                os.close(descriptor)
+        return len(paths)
+
+    def flush(self):
+        """Wait for queued writes and sync everything written"""
+        with self._lock:
+            futures = list(self._pending.values()) if self._pid == os.getpid() else []
+        for future in futures:
+            try:
+                future.result()
+            except Exception:
+                pass
+        self.sync()
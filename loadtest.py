@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+"""
+Load testing for Virtual IHC Analysis System
+Simulates pathologists logging in, uploading H&E images, reading results,
+downloading reports and browsing the dashboard while concurrency ramps up
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import shutil
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+import urllib.error
+import urllib.parse
+import urllib.request
+from http.cookiejar import CookieJar
+
+# Add current directory to Python path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from utils import allowed_file
+
+DEFAULT_MIX = 'upload=1,results=4,report=2,download=1,dashboard=3'
+
+# Started with a throwaway SQLite database and storage folders
+SERVER_CODE = """
+import sys
+from app import create_app, db
+port, work_dir = int(sys.argv[1]), sys.argv[2]
+app = create_app({
+    'UPLOAD_FOLDER': work_dir + '/uploads',
+    'GENERATED_FOLDER': work_dir + '/generated',
+    'SIMILARITY_INDEX_FOLDER': work_dir + '/similarity_index',
+    'ARRAY_STORE_FOLDER': work_dir + '/array_store',
+})
+with app.app_context():
+    db.create_all()
+app.run(host='127.0.0.1', port=port, threaded=True, use_reloader=False)
+"""
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    """Time each request on its own instead of following redirects"""
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+def _multipart(fields, files):
+    """Encode form fields and (name, filename, bytes) files as multipart/form-data"""
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for name, filename, content in files:
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; '
+                     f'filename="{filename}"\r\nContent-Type: application/octet-stream\r\n\r\n'.encode())
+        parts.append(content + b'\r\n')
+    parts.append(f'--{boundary}--\r\n'.encode())
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+class Recorder:
+    """Thread-safe store of (route, latency, ok) samples for the current stage"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = []
+
+    def add(self, route, latency, ok):
+        with self._lock:
+            self.samples.append((route, latency, ok))
+
+    def drain(self):
+        with self._lock:
+            samples, self.samples = self.samples, []
+        return samples
+
+class SimulatedUser:
+    """One pathologist with their own cookie session and uploaded cases"""
+
+    def __init__(self, base_url, username, password, recorder, timeout=120):
+        self.base_url = base_url.rstrip('/')
+        self.username = username
+        self.password = password
+        self.recorder = recorder
+        self.timeout = timeout
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(CookieJar()), _NoRedirect())
+        self.session_ids = []
+
+    def request(self, route, path, data=None, content_type=None, ok=None):
+        """Send one request, record its latency under route and return (status, location)"""
+        headers = {'Content-Type': content_type} if content_type else {}
+        request = urllib.request.Request(self.base_url + path, data=data, headers=headers)
+        start = time.perf_counter()
+        status, location = None, None
+        try:
+            with self.opener.open(request, timeout=self.timeout) as response:
+                response.read()
+                status = response.status
+        except urllib.error.HTTPError as e:
+            e.read()
+            status = e.code
+            location = e.headers.get('Location')
+        except (urllib.error.URLError, OSError):
+            pass
+        latency = time.perf_counter() - start
+
+        if ok is None:
+            succeeded = status is not None and status < 400
+        else:
+            succeeded = status is not None and ok(status, location)
+        self.recorder.add(route, latency, succeeded)
+        return status, location
+
+    def _form(self, fields):
+        return urllib.parse.urlencode(fields).encode(), 'application/x-www-form-urlencoded'
+
+    def register(self):
+        """Create the account (not timed as part of the workload)"""
+        data, content_type = self._form({
+            'first_name': 'Load', 'last_name': 'Test', 'username': self.username,
+            'email': f'{self.username}@loadtest.local',
+            'password': self.password, 'confirm_password': self.password
+        })
+        return self.request('setup', '/register', data, content_type)
+
+    def login(self):
+        data, content_type = self._form({'username': self.username, 'password': self.password})
+        return self.request('/login', '/login', data, content_type,
+                            ok=lambda status, location: status == 302 and '/login' not in (location or ''))
+
+    def upload(self, image_name, image_bytes):
+        """Upload an H&E image; success means a redirect to its results page"""
+        data, content_type = _multipart({}, [('he_image', image_name, image_bytes)])
+        status, location = self.request('/process_image', '/process_image', data, content_type,
+                                        ok=lambda status, location: '/results/' in (location or ''))
+        if location and '/results/' in location:
+            self.session_ids.append(location.rstrip('/').rsplit('/', 1)[-1])
+
+    def poll_results(self):
+        if self.session_ids:
+            self.request('/results/<session_id>', f'/results/{random.choice(self.session_ids)}')
+
+    def view_report(self):
+        if self.session_ids:
+            self.request('/report/<session_id>', f'/report/{random.choice(self.session_ids)}')
+
+    def download_report(self):
+        if self.session_ids:
+            self.request('/download_report/<session_id>', f'/download_report/{random.choice(self.session_ids)}')
+
+    def dashboard(self):
+        self.request('/dashboard', '/dashboard')
+
+def parse_mix(value):
+    """Parse "action=weight,..." into parallel lists of actions and weights"""
+    actions = {'upload', 'results', 'report', 'download', 'dashboard'}
+    mix = {}
+    for item in value.split(','):
+        name, weight = item.split('=', 1)
+        name = name.strip()
+        if name not in actions:
+            raise ValueError(f"Unknown action in mix: {name}")
+        mix[name] = float(weight)
+    return list(mix), list(mix.values())
+
+def load_images(image_dir):
+    """Read H&E images below image_dir into memory so disk reads are not measured"""
+    images = []
+    for root, dirs, files in os.walk(image_dir):
+        dirs.sort()
+        for name in sorted(files):
+            if allowed_file(name):
+                with open(os.path.join(root, name), 'rb') as handle:
+                    images.append((name, handle.read()))
+    if not images:
+        raise ValueError(f"No fixture images found in {image_dir}")
+    return images
+
+def synthetic_images(count=8, sizes=((1024, 768), (2048, 1536)), seed=0):
+    """
+    Synthetic H&E-like JPEG fixtures: pink eosin stroma with purple
+    hematoxylin nuclei, in sizes that exercise the scaled JPEG decode
+    """
+    import cv2
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    images = []
+    for index in range(count):
+        width, height = sizes[index % len(sizes)]
+        image = np.empty((height, width, 3), dtype=np.uint8)
+        image[...] = (200, 165, 225)  # BGR eosin background
+        for _ in range(width * height // 2000):
+            center = (int(rng.integers(width)), int(rng.integers(height)))
+            axes = (int(rng.integers(4, 12)), int(rng.integers(4, 12)))
+            shade = int(rng.integers(-25, 25))
+            cv2.ellipse(image, center, axes, float(rng.integers(180)), 0, 360,
+                        (150 + shade, 60 + shade, 95 + shade), -1)
+        image = cv2.GaussianBlur(image, (5, 5), 0)
+        noise = rng.normal(0, 6, image.shape)
+        image = np.clip(image + noise, 0, 255).astype(np.uint8)
+        ok, encoded = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, 90])
+        images.append((f"synthetic_he_{index}.jpg", encoded.tobytes()))
+    return images
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def start_server(work_dir, port=None, startup_timeout=120):
+    """Start the app on a temporary SQLite database; return (process, base_url)"""
+    port = port or _free_port()
+    env = dict(os.environ, DATABASE_URL=f"sqlite:///{os.path.join(work_dir, 'loadtest.db')}")
+    env.setdefault('LOG_LEVEL', 'WARNING')
+    log = open(os.path.join(work_dir, 'server.log'), 'w')
+    process = subprocess.Popen([sys.executable, '-c', SERVER_CODE, str(port), work_dir],
+                               cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+                               stdout=log, stderr=subprocess.STDOUT)
+    base_url = f"http://127.0.0.1:{port}"
+
+    deadline = time.time() + startup_timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            log.close()
+            with open(log.name) as handle:
+                raise RuntimeError("Server exited during startup:\n" + handle.read()[-2000:])
+        try:
+            with urllib.request.urlopen(base_url + '/login', timeout=2):
+                return process, base_url
+        except (urllib.error.URLError, OSError):
+            time.sleep(0.25)
+    process.terminate()
+    raise RuntimeError("Server did not start in time")
+
+def _run_user(user, actions, weights, images, deadline, think_time):
+    """Run one user's request mix until the stage deadline"""
+    handlers = {
+        'upload': lambda: user.upload(*random.choice(images)),
+        'results': user.poll_results,
+        'report': user.view_report,
+        'download': user.download_report,
+        'dashboard': user.dashboard
+    }
+    while time.time() < deadline:
+        action = random.choices(actions, weights)[0]
+        # Reading a case needs one first
+        if action != 'dashboard' and not user.session_ids:
+            action = 'upload'
+        handlers[action]()
+        if think_time:
+            time.sleep(random.uniform(0, 2 * think_time))
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+def summarize(samples, elapsed):
+    """Per-route request count, throughput, latency percentiles (ms) and error rate"""
+    by_route = {}
+    for route, latency, ok in samples:
+        by_route.setdefault(route, []).append((latency, ok))
+
+    summary = {}
+    for route in sorted(by_route):
+        latencies = sorted(latency for latency, ok in by_route[route])
+        errors = sum(1 for latency, ok in by_route[route] if not ok)
+        summary[route] = {
+            'requests': len(latencies),
+            'throughput': len(latencies) / elapsed if elapsed else 0.0,
+            'p50_ms': percentile(latencies, 0.50) * 1000,
+            'p95_ms': percentile(latencies, 0.95) * 1000,
+            'p99_ms': percentile(latencies, 0.99) * 1000,
+            'error_rate': errors / len(latencies)
+        }
+    return summary
+
+def print_stage(concurrency, summary):
+    print(f"\nConcurrency {concurrency}")
+    print(f"{'route':<32}{'reqs':>7}{'req/s':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'errors':>9}")
+    for route, stats in summary.items():
+        print(f"{route:<32}{stats['requests']:>7}{stats['throughput']:>9.2f}{stats['p50_ms']:>10.1f}"
+              f"{stats['p95_ms']:>10.1f}{stats['p99_ms']:>10.1f}{stats['error_rate']:>8.1%}")
+
+def run_load_test(base_url, stages, duration, images, mix=DEFAULT_MIX, think_time=0.5, max_error_rate=None):
+    """Ramp through concurrency stages and return one summary per stage"""
+    actions, weights = parse_mix(mix)
+    recorder = Recorder()
+    password = 'loadtest-password'
+    run_id = uuid.uuid4().hex[:8]
+
+    users = []
+    for i in range(max(stages)):
+        user = SimulatedUser(base_url, f"load_{run_id}_{i}", password, recorder)
+        user.register()
+        user.login()
+        users.append(user)
+    recorder.drain()
+
+    results = []
+    for concurrency in stages:
+        deadline = time.time() + duration
+        start = time.perf_counter()
+        threads = [threading.Thread(target=_run_user, daemon=True,
+                                    args=(user, actions, weights, images, deadline, think_time))
+                   for user in users[:concurrency]]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        summary = summarize(recorder.drain(), time.perf_counter() - start)
+        results.append({'concurrency': concurrency, 'routes': summary})
+        print_stage(concurrency, summary)
+
+        if max_error_rate is not None and any(stats['error_rate'] > max_error_rate
+                                              for stats in summary.values()):
+            print(f"Stopping ramp: error rate above {max_error_rate:.0%}")
+            break
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load-test the Virtual IHC web application')
+    parser.add_argument('--url', default=None,
+                        help='Test an already running server instead of starting one with SQLite')
+    parser.add_argument('--images', default=None,
+                        help='Directory of H&E images to upload (searched recursively); '
+                             'synthetic fixtures are generated when omitted')
+    parser.add_argument('--stages', default='1,2,4,8',
+                        help='Comma-separated number of concurrent users per stage')
+    parser.add_argument('--duration', type=float, default=30.0, help='Seconds per stage')
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help='Relative weights of upload, results, report, download and dashboard')
+    parser.add_argument('--think-time', type=float, default=0.5,
+                        help='Mean pause between a user\'s requests in seconds')
+    parser.add_argument('--max-error-rate', type=float, default=None,
+                        help='Stop ramping once any route exceeds this error rate (0-1)')
+    parser.add_argument('--json', dest='json_path', default=None, help='Also write the results as JSON')
+    args = parser.parse_args(argv)
+
+    stages = [int(stage) for stage in args.stages.split(',')]
+    # Synthetic by default, so no patient images are re-uploaded by accident
+    images = load_images(args.images) if args.images else synthetic_images()
+
+    work_dir = None
+    process = None
+    try:
+        if args.url:
+            base_url = args.url
+        else:
+            work_dir = tempfile.mkdtemp(prefix='virtual_ihc_loadtest_')
+            process, base_url = start_server(work_dir)
+            print(f"Started server at {base_url} (data in {work_dir})")
+
+        results = run_load_test(base_url, stages, args.duration, images, mix=args.mix,
+                                think_time=args.think_time, max_error_rate=args.max_error_rate)
+        if args.json_path:
+            with open(args.json_path, 'w') as handle:
+                json.dump(results, handle, indent=2)
+            print(f"\nResults written to {args.json_path}")
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=30)
+        if work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+import os
+import sys
+import json
+import queue
+import atexit
+import logging
+import itertools
+import threading
+from datetime import datetime, timezone
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener
+
+# Analysis context attached to every record logged on the current request
+_session_id = ContextVar('log_session_id', default=None)
+_phase = ContextVar('log_phase', default=None)
+
+_listener = None
+_lock = threading.Lock()
+
+def bind_log_context(session_id=None, phase=None):
+    """Set the session ID and/or pipeline phase reported with later records"""
+    if session_id is not None:
+        _session_id.set(session_id)
+    if phase is not None:
+        _phase.set(phase)
+
+def clear_log_context(exc=None):
+    """Forget the session ID and phase, e.g. at the end of a request"""
+    _session_id.set(None)
+    _phase.set(None)
+
+class ContextFilter(logging.Filter):
+    """Copy the bound session ID and phase onto each record"""
+
+    def filter(self, record):
+        record.session_id = _session_id.get()
+        record.phase = _phase.get()
+        return True
+
+class SamplingFilter(logging.Filter):
+    """Keep 1 in N DEBUG/INFO records from configured high-volume loggers"""
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+        self._counters = {name: itertools.count() for name in rates}
+
+    def filter(self, record):
+        if record.levelno > logging.INFO:
+            return True
+        name = record.name
+        while name:
+            if name in self.rates:
+                return next(self._counters[name]) % self.rates[name] == 0
+            name = name.rpartition('.')[0]
+        return True
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record"""
+
+    def format(self, record):
+        entry = {
+            'timestamp': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'session_id': getattr(record, 'session_id', None),
+            'phase': getattr(record, 'phase', None),
+            'thread': record.threadName
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+class DeferredQueueHandler(QueueHandler):
+    """
+    Queue records without formatting them on the calling thread
+    Only the message arguments are resolved (they may change after the call);
+    JSON encoding and stream I/O happen on the listener thread
+    """
+
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+def _parse_mapping(value, convert):
+    """Parse "name=value,name=value" settings"""
+    mapping = {}
+    for item in (value or '').split(','):
+        if '=' in item:
+            name, setting = item.split('=', 1)
+            mapping[name.strip()] = convert(setting.strip())
+    return mapping
+
+def configure_logging(level='INFO', module_levels=None, sampling=None, json_format=True, stream=None):
+    """
+    Route all logging through a queue to a background listener thread
+    module_levels and sampling accept dicts or "name=value,..." strings
+    """
+    global _listener
+    with _lock:
+        if _listener is not None:
+            _listener.stop()
+
+        if isinstance(module_levels, str):
+            module_levels = _parse_mapping(module_levels, str.upper)
+        if isinstance(sampling, str):
+            sampling = _parse_mapping(sampling, int)
+
+        output = logging.StreamHandler(stream or sys.stderr)
+        output.setFormatter(JsonFormatter() if json_format else
+                            logging.Formatter('%(asctime)s %(levelname)s %(name)s [%(session_id)s %(phase)s] %(message)s'))
+
+        log_queue = queue.SimpleQueue()
+        handler = DeferredQueueHandler(log_queue)
+        handler.addFilter(ContextFilter())
+        if sampling:
+            handler.addFilter(SamplingFilter(sampling))
+
+        root = logging.getLogger()
+        for existing in list(root.handlers):
+            root.removeHandler(existing)
+        root.addHandler(handler)
+        root.setLevel(level.upper() if isinstance(level, str) else level)
+
+        for name, module_level in (module_levels or {}).items():
+            logging.getLogger(name).setLevel(module_level)
+
+        _listener = QueueListener(log_queue, output)
+        _listener.start()
+
+    return _listener
+
+def stop_logging():
+    """Flush queued records and stop the listener thread"""
+    global _listener
+    with _lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
+
+def _restart_after_fork():
+    """
+    Start a new listener in a forked child (e.g. a gunicorn worker of a
+    preloaded app); the parent's listener thread does not exist there
+    """
+    global _listener, _lock
+    _lock = threading.Lock()
+    if _listener is None:
+        return
+    # Records queued before the fork are the parent's to write
+    log_queue = _listener.queue
+    while True:
+        try:
+            log_queue.get_nowait()
+        except queue.Empty:
+            break
+    _listener = QueueListener(log_queue, *_listener.handlers)
+    _listener.start()
+
+atexit.register(stop_logging)
+os.register_at_fork(after_in_child=_restart_after_fork)
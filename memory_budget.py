@@ -0,0 +1,260 @@
+import os
+import json
+import time
+import uuid
+import fcntl
+import logging
+import threading
+import tracemalloc
+from collections import deque
+from contextlib import contextmanager
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# Fixed cost of one analysis at model resolution: preprocessing, synthetic
+# IHC, classifier views, heatmap and report (about 20 MB measured with
+# MEMORY_TRACE), with headroom
+BASE_FOOTPRINT = 32 * 1024 * 1024
+# JPEG decoders can scale down by these factors while decoding
+JPEG_REDUCTIONS = (8, 4, 2)
+
+def image_header(source):
+    """(width, height, format) from an image header, without decoding pixels"""
+    with Image.open(source) as image:
+        return image.width, image.height, image.format
+
+def decode_reduction(width, height, image_format, target_size):
+    """Largest JPEG scale-down factor that still decodes at least target_size"""
+    if image_format != 'JPEG':
+        return 1
+    for factor in JPEG_REDUCTIONS:
+        if width // factor >= target_size[0] and height // factor >= target_size[1]:
+            return factor
+    return 1
+
+def estimate_footprint(source, input_size=(256, 256), base_bytes=BASE_FOOTPRINT):
+    """
+    Expected peak bytes of analysing one image, from its header dimensions
+    The decoded RGB input dominates; everything after the resize to
+    input_size is covered by base_bytes
+    """
+    width, height, image_format = image_header(source)
+    factor = decode_reduction(width, height, image_format, input_size)
+    return (width // factor) * (height // factor) * 3 + base_bytes
+
+def current_rss():
+    """Resident set size of this process in bytes"""
+    try:
+        with open('/proc/self/statm') as handle:
+            return int(handle.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        # Peak rather than current RSS, in KiB on Linux, where statm exists anyway
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+class _RSSSampler(threading.Thread):
+    """Polls RSS in the background and keeps the highest value seen"""
+
+    def __init__(self, interval):
+        super().__init__(name='rss-sampler', daemon=True)
+        self.interval = interval
+        self.start_rss = self.peak_rss = current_rss()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.peak_rss = max(self.peak_rss, current_rss())
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        self.peak_rss = max(self.peak_rss, current_rss())
+        return self.start_rss, self.peak_rss
+
+class MemoryMeter:
+    """
+    Per-stage memory accounting of one job
+    Each stage records its duration, the process RSS at its start and the
+    highest RSS sampled while it ran; when tracemalloc is tracing, also the
+    peak of Python/NumPy allocations above those live when it started.
+    Both are process-wide, so stages of concurrent jobs overlap
+    """
+
+    def __init__(self, interval=0.01):
+        """Initialize the RSS sampling interval in seconds"""
+        self.interval = interval
+        self.stages = []
+
+    @contextmanager
+    def stage(self, name):
+        sampler = _RSSSampler(self.interval)
+        sampler.start()
+        traced_base = None
+        if tracemalloc.is_tracing():
+            traced_base = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - started
+            rss_start, rss_peak = sampler.stop()
+            traced_peak = None
+            if traced_base is not None:
+                traced_peak = max(tracemalloc.get_traced_memory()[1] - traced_base, 0)
+            self.stages.append({
+                'stage': name,
+                'seconds': seconds,
+                'rss_start': rss_start,
+                'rss_peak': rss_peak,
+                'traced_peak': traced_peak
+            })
+            logger.debug("Stage %s: %.2fs, RSS %s -> %s bytes, traced peak %s bytes",
+                         name, seconds, rss_start, rss_peak, traced_peak)
+
+class MemoryBudget:
+    """
+    Admission control for memory-heavy jobs
+    Jobs reserve their expected footprint before running and wait, in
+    arrival order, until it fits in max_bytes next to the jobs already
+    admitted. A job larger than the whole budget runs alone. max_bytes of
+    0 disables the budget
+    """
+
+    def __init__(self, max_bytes):
+        """Initialize the budget in bytes"""
+        self.max_bytes = max_bytes
+        self.reserved = 0
+        self.active = 0
+        self._condition = threading.Condition()
+        self._waiting = deque()
+
+    def _fits(self, nbytes):
+        return self.max_bytes <= 0 or self.active == 0 or self.reserved + nbytes <= self.max_bytes
+
+    def acquire(self, nbytes, timeout=None):
+        """Reserve nbytes, waiting up to timeout seconds; returns whether it was admitted"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        ticket = object()
+        with self._condition:
+            self._waiting.append(ticket)
+            try:
+                # Only the oldest waiter may be admitted, so large jobs are not starved
+                while self._waiting[0] is not ticket or not self._fits(nbytes):
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        return False
+                    self._condition.wait(remaining)
+                self.reserved += nbytes
+                self.active += 1
+                return True
+            finally:
+                self._waiting.remove(ticket)
+                self._condition.notify_all()
+
+    def release(self, nbytes):
+        """Return a reservation made by acquire"""
+        with self._condition:
+            self.reserved -= nbytes
+            self.active -= 1
+            self._condition.notify_all()
+
+class SharedMemoryBudget:
+    """
+    MemoryBudget shared by every process on the host through a state file
+    Reservations and the queue of waiters are kept in a JSON file that is
+    read and rewritten under an exclusive flock, so Gunicorn workers and
+    threads all draw from one budget. Waiters poll the file; entries of
+    processes that have exited are dropped, so a killed worker does not
+    hold its reservation forever
+    """
+
+    def __init__(self, path, max_bytes, poll_interval=0.05):
+        """Initialize the state file path, budget in bytes and polling interval"""
+        self.path = path
+        self.max_bytes = max_bytes
+        self.poll_interval = poll_interval
+        self._thread_lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+    @contextmanager
+    def _state(self):
+        """Load the shared state under the lock and write it back afterwards"""
+        with self._thread_lock, open(self.path + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                try:
+                    with open(self.path) as handle:
+                        state = json.load(handle)
+                except (OSError, ValueError):
+                    state = {'reserved': {}, 'waiting': []}
+                _prune_exited(state)
+                yield state
+                temp_path = self.path + '.tmp'
+                with open(temp_path, 'w') as handle:
+                    json.dump(state, handle)
+                os.replace(temp_path, self.path)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _fits(self, state, nbytes):
+        reserved = sum(size for _, size in state['reserved'].values())
+        return self.max_bytes <= 0 or not state['reserved'] or reserved + nbytes <= self.max_bytes
+
+    def acquire(self, nbytes, timeout=None):
+        """Reserve nbytes, waiting up to timeout seconds; returns whether it was admitted"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        ticket = uuid.uuid4().hex
+        pid = os.getpid()
+        with self._state() as state:
+            state['waiting'].append([ticket, pid])
+        try:
+            while True:
+                with self._state() as state:
+                    if all(entry[0] != ticket for entry in state['waiting']):
+                        # The state file was removed while waiting
+                        state['waiting'].append([ticket, pid])
+                    # Only the oldest waiter may be admitted, so large jobs are not starved
+                    if state['waiting'][0][0] == ticket and self._fits(state, nbytes):
+                        state['waiting'].pop(0)
+                        state['reserved'][ticket] = [pid, nbytes]
+                        ticket = None
+                        return True
+                if deadline is not None and time.monotonic() >= deadline:
+                    return False
+                time.sleep(self.poll_interval)
+        finally:
+            if ticket is not None:
+                with self._state() as state:
+                    state['waiting'] = [entry for entry in state['waiting'] if entry[0] != ticket]
+
+    def release(self, nbytes):
+        """Return a reservation of nbytes made by acquire in this process"""
+        pid = os.getpid()
+        with self._state() as state:
+            for ticket, (owner, size) in state['reserved'].items():
+                if owner == pid and size == nbytes:
+                    del state['reserved'][ticket]
+                    break
+
+def _prune_exited(state):
+    """Drop the reservations and waiters of processes that no longer exist"""
+    alive = {}
+    def is_alive(pid):
+        if pid not in alive:
+            try:
+                os.kill(pid, 0)
+                alive[pid] = True
+            except ProcessLookupError:
+                alive[pid] = False
+            except PermissionError:
+                alive[pid] = True
+        return alive[pid]
+    state['reserved'] = {ticket: entry for ticket, entry in state['reserved'].items() if is_alive(entry[0])}
+    state['waiting'] = [entry for entry in state['waiting'] if is_alive(entry[1])]
+
+def init_app(app):
+    """Start tracemalloc when per-stage allocation peaks are wanted"""
+    if app.config.get('MEMORY_TRACE') and not tracemalloc.is_tracing():
+        tracemalloc.start()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+Database migration for Virtual IHC Analysis System
+Copies every table between SQLite (embedded mode) and MySQL, in either direction
+"""
+import os
+import sys
+import argparse
+import logging
+from sqlalchemy import select, func
+
+# Add current directory to Python path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from app import db
+import models  # registers the tables on db.metadata
+import database
+from logging_setup import configure_logging
+
+logger = logging.getLogger(__name__)
+
+def _row_count(connection, table):
+    return connection.execute(select(func.count()).select_from(table)).scalar()
+
+def migrate(source_uri, target_uri, replace=False, chunk_size=1000):
+    """
+    Copy all rows from the source database to the target one
+    Tables and indexes are created on the target as needed; rows keep their
+    primary keys, so foreign keys stay valid. Returns {table: rows copied}
+    """
+    source = database.create_configured_engine(source_uri)
+    target = database.create_configured_engine(target_uri)
+    metadata = db.metadata
+    database.ensure_indexes(target, metadata)
+
+    copied = {}
+    with source.connect() as source_connection, target.begin() as target_connection:
+        if replace:
+            # Children first so foreign keys are never left dangling
+            for table in reversed(metadata.sorted_tables):
+                target_connection.execute(table.delete())
+        else:
+            for table in metadata.sorted_tables:
+                if _row_count(target_connection, table):
+                    raise ValueError(f"Target table {table.name} is not empty (use --replace)")
+
+        # Parents first (users before sessions before results)
+        for table in metadata.sorted_tables:
+            result = source_connection.execution_options(stream_results=True).execute(
+                select(table).order_by(*table.primary_key.columns)
+            )
+            count = 0
+            for rows in result.mappings().partitions(chunk_size):
+                target_connection.execute(table.insert(), [dict(row) for row in rows])
+                count += len(rows)
+            copied[table.name] = count
+            logger.info("Copied %s rows of %s", count, table.name)
+
+        # Verify inside the transaction so a mismatch rolls everything back
+        for table in metadata.sorted_tables:
+            if _row_count(target_connection, table) != copied[table.name]:
+                raise RuntimeError(f"Row count mismatch for {table.name}")
+
+    source.dispose()
+    target.dispose()
+    return copied
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Copy the Virtual IHC database between SQLite and MySQL')
+    parser.add_argument('source', help='Source database URL, e.g. sqlite:///instance/virtual_ihc.db')
+    parser.add_argument('target', help='Target database URL, e.g. mysql+pymysql://root:@localhost/virtual_ihc_db')
+    parser.add_argument('--replace', action='store_true', help='Delete existing rows in the target first')
+    parser.add_argument('--chunk-size', type=int, default=1000, help='Rows inserted per statement')
+    args = parser.parse_args(argv)
+
+    configure_logging(level=os.environ.get('LOG_LEVEL', 'INFO'),
+                      json_format=os.environ.get('LOG_FORMAT', 'json') == 'json')
+    copied = migrate(args.source, args.target, replace=args.replace, chunk_size=args.chunk_size)
+    for table, count in copied.items():
+        print(f"{table}: {count} rows")
+
+if __name__ == '__main__':
+    main()
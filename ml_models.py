@@ -5,6 +5,24 @@ from PIL import Image
 import logging
 import time
 import random
+from quantification import CellQuantifier
+from features import FEATURE_NAMES, GLCM_LEVELS, FeatureExtractor
+import heatmap
+from memory_budget import image_header, decode_reduction
+from storage import preview_path
+
+logger = logging.getLogger(__name__)
+
+# Breast cancer IHC panel; HER2 comes from the main head, the rest from MarkerHeads
+MARKER_PANEL = ('HER2', 'ER', 'PR', 'Ki-67')
+
+# cv2.imread flags per decode_reduction factor
+REDUCED_DECODE_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8
+}
 
 class HEToIHCConverter:
     """
@@ -13,11 +31,25 @@ class HEToIHCConverter:
     In production, this would load and use a trained Pix2Pix model
     """
     
+    # Bump whenever the weights or pre/postprocessing change the generated images
+    version = 'pix2pix-synthetic-1.1'
+    
     def __init__(self):
         """Initialize the converter with model parameters"""
         self.model_loaded = False
         self.input_size = (256, 256)
-        logging.info("HEToIHCConverter initialized")
+        
+        # Optional StainNormalizer applied before model input
+        self.stain_normalizer = None
+        
+        # Optional ImageWriter; without one results are saved as PNG synchronously
+        self.image_writer = None
+        logger.info("HEToIHCConverter initialized")
+    
+    @property
+    def output_extension(self):
+        """File extension of the images written by convert"""
+        return self.image_writer.extension if self.image_writer else '.png'
         
     def load_model(self, model_path):
         """Load pre-trained Pix2Pix model"""
@@ -25,24 +57,34 @@ class HEToIHCConverter:
             # In production, load actual TensorFlow/PyTorch model here
             # self.model = tf.keras.models.load_model(model_path)
             self.model_loaded = True
-            logging.info(f"Model loaded from {model_path}")
+            logger.info("Model loaded from %s", model_path)
         except Exception as e:
-            logging.error(f"Failed to load model: {str(e)}")
+            logger.error("Failed to load model: %s", e)
             raise
     
-    def preprocess_image(self, image_path):
+    def preprocess_image(self, image_path, stain_profile=None):
         """Preprocess H&E image for model input"""
         try:
-            # Load image
-            image = cv2.imread(image_path)
+            # Load image; large JPEGs are scaled down by the decoder itself
+            # so the full-resolution pixels are never held in memory
+            width, height, image_format = image_header(image_path)
+            reduction = decode_reduction(width, height, image_format, self.input_size)
+            image = cv2.imread(image_path, REDUCED_DECODE_FLAGS[reduction])
             if image is None:
                 raise ValueError(f"Could not load image from {image_path}")
             
-            # Convert BGR to RGB
+            # Resize to model input size, then convert BGR to RGB at that size
+            image = cv2.resize(image, self.input_size)
             image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
             
-            # Resize to model input size
-            image = cv2.resize(image, self.input_size)
+            # Map scanner/lab stain appearance onto the reference profile
+            if self.stain_normalizer is not None:
+                try:
+                    image = self.stain_normalizer.normalize(image, source_profile=stain_profile)
+                except (ValueError, KeyError) as e:
+                    # Mostly background (too little stain to estimate from), or
+                    # a profile that has not been fitted for this method
+                    logger.warning("Stain normalization skipped: %s", e)
             
             # Normalize pixel values to [-1, 1] for GAN
             image = (image.astype(np.float32) / 127.5) - 1.0
@@ -52,7 +94,7 @@ class HEToIHCConverter:
             
             return image
         except Exception as e:
-            logging.error(f"Image preprocessing failed: {str(e)}")
+            logger.error("Image preprocessing failed: %s", e)
             raise
     
     def postprocess_image(self, generated_image):
@@ -69,19 +111,19 @@ class HEToIHCConverter:
             
             return image
         except Exception as e:
-            logging.error(f"Image postprocessing failed: {str(e)}")
+            logger.error("Image postprocessing failed: %s", e)
             raise
     
-    def convert(self, he_image_path, output_path):
-        """Convert H&E image to virtual IHC image"""
+    def convert(self, he_image_path, output_path, stain_profile=None):
+        """Convert H&E image to virtual IHC image, returning it as RGB uint8"""
         try:
-            logging.info(f"Converting {he_image_path} to virtual IHC")
+            logger.info("Converting %s to virtual IHC", he_image_path)
             
             # Simulate processing time
             time.sleep(2)
             
             # Preprocess input image
-            preprocessed = self.preprocess_image(he_image_path)
+            preprocessed = self.preprocess_image(he_image_path, stain_profile=stain_profile)
             
             # In production, use actual model inference:
             # generated = self.model.predict(preprocessed)
@@ -92,14 +134,21 @@ class HEToIHCConverter:
             # Postprocess output
             ihc_image = self.postprocess_image(generated)
             
-            # Save generated image
-            ihc_pil = Image.fromarray(ihc_image)
-            ihc_pil.save(output_path)
+            # Save generated image; with a writer, encoding runs in the background
+            if self.image_writer is not None:
+                self.image_writer.submit(ihc_image, output_path)
+                if self.image_writer.writes_preview:
+                    self.image_writer.submit(ihc_image, preview_path(output_path), encoding='jpeg')
+                logger.info("Virtual IHC queued for writing to %s", output_path)
+            else:
+                ihc_pil = Image.fromarray(ihc_image)
+                ihc_pil.save(output_path)
+                logger.info("Virtual IHC saved to %s", output_path)
             
-            logging.info(f"Virtual IHC saved to {output_path}")
+            return ihc_image
             
         except Exception as e:
-            logging.error(f"H&E to IHC conversion failed: {str(e)}")
+            logger.error("H&E to IHC conversion failed: %s", e)
             raise
     
     def _generate_synthetic_ihc(self, he_image):
@@ -145,12 +194,25 @@ class CancerClassifier:
     Predicts HER2 expression levels and other biomarkers
     """
     
-    def __init__(self):
-        """Initialize the classifier"""
+    # Bump whenever the weights or decision logic change the predictions
+    version = 'her2-synthetic-1.0'
+    
+    def __init__(self, tta=False):
+        """Initialize the classifier; tta enables test-time augmentation by default"""
         self.model_loaded = False
         self.class_names = ['negative', 'positive', 'equivocal']
         self.input_size = (224, 224)
-        logging.info("CancerClassifier initialized")
+        self.tta = tta
+        
+        # Synthetic spatial layer over an 8x8 pooled grid, standing in for the
+        # orientation-sensitive part of a CNN so augmented views can disagree
+        self.pool_grid = 8
+        self.spatial_weights = np.random.default_rng(1).normal(
+            0, 2.0, (self.pool_grid * self.pool_grid, len(self.class_names))).astype(np.float32)
+        self.quantifier = CellQuantifier()
+        self.feature_extractor = FeatureExtractor()
+        self.marker_heads = MarkerHeads()
+        logger.info("CancerClassifier initialized")
     
     def load_model(self, model_path):
         """Load pre-trained classification model"""
@@ -158,21 +220,26 @@ class CancerClassifier:
             # In production, load actual CNN model here
             # self.model = tf.keras.models.load_model(model_path)
             self.model_loaded = True
-            logging.info(f"Classification model loaded from {model_path}")
+            logger.info("Classification model loaded from %s", model_path)
         except Exception as e:
-            logging.error(f"Failed to load classification model: {str(e)}")
+            logger.error("Failed to load classification model: %s", e)
             raise
     
-    def preprocess_image(self, image_path):
+    def load_image(self, image_path):
+        """Load an IHC image as full-resolution RGB uint8"""
+        image = cv2.imread(image_path)
+        if image is None:
+            raise ValueError(f"Could not load image from {image_path}")
+        
+        # Convert BGR to RGB
+        return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    
+    def preprocess_image(self, image_path, image=None):
         """Preprocess IHC image for classification"""
         try:
-            # Load image
-            image = cv2.imread(image_path)
+            # Load image unless the caller already decoded it
             if image is None:
-                raise ValueError(f"Could not load image from {image_path}")
-            
-            # Convert BGR to RGB
-            image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+                image = self.load_image(image_path)
             
             # Resize for classification model
             image = cv2.resize(image, self.input_size)
@@ -185,38 +252,139 @@ class CancerClassifier:
             
             return image
         except Exception as e:
-            logging.error(f"Classification preprocessing failed: {str(e)}")
+            logger.error("Classification preprocessing failed: %s", e)
             raise
     
-    def predict(self, ihc_image_path):
-        """Predict cancer severity and biomarker expression"""
+    def predict(self, ihc_image_path, panel=False, tta=None, heatmap_path=None, image=None):
+        """
+        Predict cancer severity and biomarker expression
+        With panel=True the ER, PR and Ki-67 heads also score the shared
+        features and results['markers'] holds one entry per MARKER_PANEL marker
+        With tta (default self.tta) HER2 status comes from probabilities averaged
+        over the 8 flip/rotation views and results['tta_agreement'] is reported
+        With heatmap_path a per-tile HER2 score overlay is saved there
+        image may be the already decoded (or memory-mapped) IHC image
+        """
+        if tta is None:
+            tta = self.tta
         try:
-            logging.info(f"Analyzing cancer severity from {ihc_image_path}")
+            logger.info("Analyzing cancer severity from %s", ihc_image_path)
             
             # Simulate analysis time
             time.sleep(1)
             
+            # Decode once for both quantification and classification
+            if image is None:
+                image = self.load_image(ihc_image_path)
+            
+            # Measure cell counts and stained area at full resolution
+            quantification = self.quantifier.quantify(image)
+            
             # Preprocess image
-            preprocessed = self.preprocess_image(ihc_image_path)
+            preprocessed = self.preprocess_image(ihc_image_path, image=image)
             
             # In production, use actual model prediction:
             # predictions = self.model.predict(preprocessed)
             
+            # Score all augmented views in one batched call
+            probabilities = None
+            if tta:
+                probabilities, agreement = self.predict_augmented(preprocessed)
+            
             # For academic demo: Generate realistic synthetic results
-            results = self._generate_synthetic_predictions(preprocessed)
+            results = self._generate_synthetic_predictions(preprocessed, quantification, probabilities)
+            if tta:
+                results['tta_agreement'] = agreement
+            
+            # Feature vector of the IHC image, stored with the session
+            results['features'] = self.feature_extractor.extract_image(image)
+            
+            if panel:
+                results['markers'] = self.marker_heads.score(results['features'], results, quantification)
+            
+            # Spatial HER2 scores blended onto a thumbnail of the decoded image
+            if heatmap_path:
+                results['heatmap_path'] = heatmap.save_overlay(image, self.score_tiles(image), heatmap_path)
             
-            logging.info(f"Cancer analysis completed: HER2 {results['her2_status']}")
+            logger.info("Cancer analysis completed: HER2 %s", results['her2_status'])
             
             return results
             
         except Exception as e:
-            logging.error(f"Cancer prediction failed: {str(e)}")
+            logger.error("Cancer prediction failed: %s", e)
             raise
     
-    def _generate_synthetic_predictions(self, image):
+    def augment(self, batch):
+        """Stack the 8 flip/90-degree rotation views of a (1, H, W, C) square batch"""
+        image = batch[0]
+        # Views are strided reorderings of the same pixels; np.stack copies each once
+        views = [np.rot90(image, k) for k in range(4)]
+        views += [view[:, ::-1] for view in views]
+        return np.stack(views)
+    
+    def score_batch(self, batch):
+        """
+        Class probabilities for an (N, H, W, C) [0, 1] batch, ordered as class_names
+        Synthetic stand-in for one batched forward pass of the classification model
+        """
+        gray = batch @ np.array([0.299, 0.587, 0.114], dtype=np.float32)
+        count, height, width = gray.shape
+        mean_intensity = gray.mean(axis=(1, 2))
+        std_intensity = gray.std(axis=(1, 2))
+        
+        # Same decision boundaries as the single-view synthetic predictions
+        logits = np.stack([
+            10.0 * (0.4 - mean_intensity),
+            10.0 * np.minimum(mean_intensity - 0.6, std_intensity - 0.15),
+            np.zeros_like(mean_intensity)
+        ], axis=1)
+        
+        # Spatial term: pooled grid with its mean removed, through one linear layer
+        grid = self.pool_grid
+        cropped = gray[:, :height - height % grid, :width - width % grid]
+        pooled = cropped.reshape(count, grid, cropped.shape[1] // grid, grid, -1).mean(axis=(2, 4))
+        pooled = pooled.reshape(count, -1)
+        logits += (pooled - pooled.mean(axis=1, keepdims=True)) @ self.spatial_weights
+        
+        logits -= logits.max(axis=1, keepdims=True)
+        probabilities = np.exp(logits)
+        return probabilities / probabilities.sum(axis=1, keepdims=True)
+    
+    def predict_augmented(self, preprocessed):
+        """Average class probabilities over flips and rotations; return (probabilities, agreement)"""
+        view_probabilities = self.score_batch(self.augment(preprocessed))
+        probabilities = view_probabilities.mean(axis=0)
+        
+        # Fraction of views whose top class matches the averaged prediction
+        agreement = float((view_probabilities.argmax(axis=1) == probabilities.argmax()).mean())
+        return probabilities, agreement
+    
+    def score_tiles(self, image, grid_size=16, tile_pixels=32, background=0.85):
+        """
+        HER2 score grid for an RGB uint8 image: P(positive) + P(equivocal) / 2 per tile
+        The image is resized so every tile is tile_pixels square, cut into an
+        (N, tile, tile, 3) batch by reshaping and scored in one score_batch call;
+        background (bright, unstained) tiles are NaN
+        """
+        height, width = image.shape[:2]
+        tile = max(height, width) / grid_size
+        rows, cols = max(1, int(round(height / tile))), max(1, int(round(width / tile)))
+        resized = cv2.resize(image, (cols * tile_pixels, rows * tile_pixels), interpolation=cv2.INTER_AREA)
+        
+        tiles = resized.reshape(rows, tile_pixels, cols, tile_pixels, 3).swapaxes(1, 2)
+        tiles = tiles.reshape(rows * cols, tile_pixels, tile_pixels, 3).astype(np.float32) / 255.0
+        
+        probabilities = self.score_batch(tiles)
+        scores = probabilities[:, 1] + 0.5 * probabilities[:, 2]
+        scores[tiles.mean(axis=(1, 2, 3)) > background] = np.nan
+        return scores.reshape(rows, cols)
+    
+    def _generate_synthetic_predictions(self, image, quantification=None, probabilities=None):
         """
         Generate synthetic prediction results for academic demonstration
         In production, replace with actual model inference
+        Cell counts and stained area come from the quantification when given;
+        HER2 status and confidence come from class probabilities when given
         """
         # Analyze image properties to make realistic predictions
         img_array = image[0]  # Remove batch dimension
@@ -245,6 +413,21 @@ class CancerClassifier:
             biomarker_percentage = random.uniform(0, 20)
             staining_intensity = 'weak'
         
+        if probabilities is not None:
+            predicted = self.class_names[int(np.argmax(probabilities))]
+            if predicted != her2_status:
+                her2_status = predicted
+                biomarker_percentage, staining_intensity = {
+                    'positive': (random.uniform(60, 90), 'strong'),
+                    'equivocal': (random.uniform(20, 60), 'moderate'),
+                    'negative': (random.uniform(0, 20), 'weak')
+                }[predicted]
+            confidence = float(np.max(probabilities))
+        
+        # Measured positive fraction replaces the synthetic expression level
+        if quantification and quantification['total_cells'] > 0:
+            biomarker_percentage = 100.0 * quantification['positive_cells'] / quantification['total_cells']
+        
         # Determine cancer grade
         if biomarker_percentage > 70:
             cancer_grade = 'Grade 3'
@@ -253,12 +436,17 @@ class CancerClassifier:
         else:
             cancer_grade = 'Grade 1'
         
-        # Generate cell counts (synthetic)
-        total_cells = random.randint(800, 1500)
-        positive_cells = int(total_cells * (biomarker_percentage / 100))
-        
-        # Calculate stained area
-        stained_area = biomarker_percentage * random.uniform(0.8, 1.2)
+        if quantification:
+            total_cells = quantification['total_cells']
+            positive_cells = quantification['positive_cells']
+            stained_area = quantification['stained_area']
+        else:
+            # Generate cell counts (synthetic)
+            total_cells = random.randint(800, 1500)
+            positive_cells = int(total_cells * (biomarker_percentage / 100))
+            
+            # Calculate stained area
+            stained_area = biomarker_percentage * random.uniform(0.8, 1.2)
         
         return {
             'her2_status': her2_status,
@@ -274,29 +462,93 @@ class CancerClassifier:
     def extract_features(self, image):
         """Extract morphological and texture features from IHC image"""
         try:
-            # Convert to grayscale
-            gray = cv2.cvtColor((image[0] * 255).astype(np.uint8), cv2.COLOR_RGB2GRAY)
+            # Accept a preprocessed [0, 1] batch as well as raw uint8 RGB
+            if image.dtype != np.uint8:
+                image = np.clip(image[0] * 255, 0, 255).astype(np.uint8)
             
-            # Calculate texture features
-            texture_features = {
-                'mean_intensity': np.mean(gray),
-                'std_intensity': np.std(gray),
-                'entropy': self._calculate_entropy(gray),
-                'contrast': self._calculate_contrast(gray)
-            }
+            vector = self.feature_extractor.extract_image(image)
+            texture_features = self.feature_extractor.as_dict(vector)
+            
+            # Kept for callers of the original feature set
+            texture_features['contrast'] = texture_features['std_intensity']
             
             return texture_features
         except Exception as e:
-            logging.error(f"Feature extraction failed: {str(e)}")
+            logger.error("Feature extraction failed: %s", e)
             return {}
     
-    def _calculate_entropy(self, image):
-        """Calculate image entropy"""
-        hist = cv2.calcHist([image], [0], None, [256], [0, 256])
-        hist = hist.ravel() / hist.sum()
-        entropy = -np.sum(hist * np.log2(hist + 1e-10))
-        return entropy
+    def extract_features_batch(self, images):
+        """Extract feature vectors for an (N, H, W, 3) uint8 batch in one pass"""
+        return self.feature_extractor.extract_batch(images)
+
+class MarkerHeads:
+    """
+    Lightweight ER, PR and Ki-67 heads over the shared IHC feature vector
+    All heads form one (markers x features) linear layer, so a full panel
+    costs one small matrix product on top of the single preprocessing pass
+    This is a placeholder with fixed synthetic weights; in production each
+    head would be trained on the shared backbone embedding
+    """
+    
+    MARKERS = MARKER_PANEL[1:]
+    
+    # Percentage of positive cells at which each marker is called positive/high
+    CUTOFFS = {'ER': 1.0, 'PR': 1.0, 'Ki-67': 20.0}
+    
+    def __init__(self, weight_scale=0.5):
+        """Initialize the head weights and per-feature scaling"""
+        # Bring intensities (0-255) and texture statistics onto comparable ranges
+        scale = np.ones(len(FEATURE_NAMES), dtype=np.float32)
+        for i, name in enumerate(FEATURE_NAMES):
+            if name.endswith('_intensity') or name.startswith('mean_'):
+                scale[i] = 255.0
+            elif name == 'entropy':
+                scale[i] = 8.0
+            elif name == 'glcm_contrast':
+                scale[i] = (GLCM_LEVELS - 1) ** 2
+            elif name == 'glcm_dissimilarity':
+                scale[i] = GLCM_LEVELS - 1
+        self.feature_scale = scale
+        
+        rng = np.random.default_rng(0)
+        self.weights = rng.normal(0, weight_scale, (len(self.MARKERS), len(FEATURE_NAMES))).astype(np.float32)
+        self.bias = np.array([1.0, 0.5, -0.5], dtype=np.float32)
+    
+    def score(self, features, her2_results, quantification=None):
+        """Return one result dict per MARKER_PANEL marker, HER2 first"""
+        # Anchor every head on the measured positive fraction when cells were found
+        if quantification and quantification['total_cells'] > 0:
+            fraction = quantification['positive_cells'] / quantification['total_cells']
+        else:
+            fraction = her2_results['biomarker_percentage'] / 100.0
+        fraction = min(max(fraction, 0.01), 0.99)
+        anchor = np.log(fraction / (1.0 - fraction))
+        
+        x = np.asarray(features, dtype=np.float32) / self.feature_scale
+        logits = anchor + self.weights @ (x - 0.5) + self.bias
+        percentages = 100.0 / (1.0 + np.exp(-logits))
+        
+        markers = [{
+            'marker': 'HER2',
+            'status': her2_results['her2_status'],
+            'percentage': her2_results['biomarker_percentage'],
+            'confidence': her2_results['confidence'],
+            'staining_intensity': her2_results['staining_intensity']
+        }]
+        for marker, percentage in zip(self.MARKERS, percentages.tolist()):
+            markers.append({
+                'marker': marker,
+                'status': self._status(marker, percentage),
+                'percentage': percentage,
+                'confidence': 0.5 + 0.45 * min(1.0, abs(percentage - self.CUTOFFS[marker]) / 20.0),
+                'staining_intensity': 'strong' if percentage >= 50 else 'moderate' if percentage >= 10 else 'weak'
+            })
+        return markers
     
-    def _calculate_contrast(self, image):
-        """Calculate image contrast using standard deviation"""
-        return np.std(image)
+    def _status(self, marker, percentage):
+        """ASCO/CAP-style calls for ER/PR; proliferation level for Ki-67"""
+        if marker == 'Ki-67':
+            return 'high' if percentage >= self.CUTOFFS[marker] else 'low'
+        if percentage < self.CUTOFFS[marker]:
+            return 'negative'
+        return 'low positive' if percentage < 10 else 'positive'
@@ -0,0 +1,104 @@
+import gc
+import logging
+import threading
+from flask import current_app
+
+logger = logging.getLogger(__name__)
+
+# One instance of each model per process, created on first use
+_instances = {}
+# Re-entrant: factories may request other instances
+_lock = threading.RLock()
+
+def _get(name, factory):
+    """Return the named instance, creating it once under the lock"""
+    instance = _instances.get(name)
+    if instance is None:
+        with _lock:
+            instance = _instances.get(name)
+            if instance is None:
+                instance = factory()
+                _instances[name] = instance
+    return instance
+
+def _create_converter():
+    from ml_models import HEToIHCConverter
+    converter = HEToIHCConverter()
+    converter.image_writer = get_image_writer()
+    method = current_app.config.get('STAIN_NORMALIZATION')
+    if method:
+        # Reference stain statistics are loaded once per profile and cached
+        from stain_normalization import StainNormalizer
+        normalizer = StainNormalizer(method, current_app.config['STAIN_PROFILE_FOLDER'])
+        try:
+            normalizer.get_profile(StainNormalizer.REFERENCE_PROFILE)
+            converter.stain_normalizer = normalizer
+        except KeyError:
+            logger.error("Stain normalization disabled: no '%s' profile fitted for %s; "
+                         "run `flask fit-stain-profile %s <image>` first",
+                         StainNormalizer.REFERENCE_PROFILE, method, StainNormalizer.REFERENCE_PROFILE)
+    return converter
+
+def _create_classifier():
+    from ml_models import CancerClassifier
+    return CancerClassifier(tta=current_app.config.get('CLASSIFIER_TTA', False))
+
+def _create_similarity_index():
+    from features import FEATURE_NAMES, FEATURE_VERSION
+    from similarity import CaseIndex
+    return CaseIndex(current_app.config['SIMILARITY_INDEX_FOLDER'], len(FEATURE_NAMES), FEATURE_VERSION)
+
+def _create_image_writer():
+    from image_writer import ImageWriter
+    return ImageWriter(
+        encoding=current_app.config['IHC_IMAGE_FORMAT'],
+        png_compression=current_app.config['IHC_PNG_COMPRESSION'],
+        jpeg_quality=current_app.config['IHC_JPEG_QUALITY'],
+        workers=current_app.config['IMAGE_WRITER_WORKERS'],
+        fsync_interval=current_app.config['IMAGE_FSYNC_INTERVAL']
+    )
+
+def _create_array_store():
+    from array_store import ArrayStore
+    return ArrayStore(current_app.config['ARRAY_STORE_FOLDER'], current_app.config['ARRAY_STORE_MAX_BYTES'])
+
+def _create_memory_budget():
+    from memory_budget import SharedMemoryBudget
+    return SharedMemoryBudget(current_app.config['MEMORY_BUDGET_FILE'], current_app.config['MEMORY_BUDGET_BYTES'])
+
+def get_converter():
+    """Phase 1 H&E to IHC converter"""
+    return _get('converter', _create_converter)
+
+def get_classifier():
+    """Phase 2 cancer classifier"""
+    return _get('classifier', _create_classifier)
+
+def get_similarity_index():
+    """Similar-case search index"""
+    return _get('similarity_index', _create_similarity_index)
+
+def get_image_writer():
+    """Background encoder/writer for generated images"""
+    return _get('image_writer', _create_image_writer)
+
+def get_array_store():
+    """Memory-mapped store of decoded session images"""
+    return _get('array_store', _create_array_store)
+
+def get_memory_budget():
+    """Admission control for analyses by expected memory footprint"""
+    return _get('memory_budget', _create_memory_budget)
+
+def preload(app):
+    """Load every model in the current (master) process before workers fork"""
+    with app.app_context():
+        get_converter()
+        get_classifier()
+        get_similarity_index()
+
+    # Move everything allocated so far out of the collector's reach, so its
+    # reference-count writes do not un-share copy-on-write pages in workers
+    gc.collect()
+    gc.freeze()
+    logger.info("Models preloaded for copy-on-write sharing")
@@ -1,7 +1,9 @@
+import os
 from datetime import datetime
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
 from app import db
+import storage
 
 class AnalysisSession(db.Model):
     """Model to store analysis sessions and results"""
@@ -11,6 +13,7 @@ class AnalysisSession(db.Model):
     original_filename = db.Column(db.String(255), nullable=False)
     he_image_path = db.Column(db.String(500), nullable=False)
     ihc_image_path = db.Column(db.String(500))
+    heatmap_image_path = db.Column(db.String(500))  # HER2 tile-score overlay on the IHC thumbnail
     
     # Prediction results
     her2_prediction = db.Column(db.String(20))  # positive, negative, equivocal
@@ -18,6 +21,14 @@ class AnalysisSession(db.Model):
     cancer_grade = db.Column(db.String(10))
     biomarker_percentage = db.Column(db.Float)
     staining_intensity = db.Column(db.String(20))  # weak, moderate, strong
+    tta_agreement = db.Column(db.Float)  # fraction of augmented views agreeing, when TTA is on
+    
+    # Expected peak bytes from the input's header dimensions, used for admission
+    memory_estimate = db.Column(db.BigInteger)
+    
+    # Model versions that produced the stored images and results
+    converter_version = db.Column(db.String(50))
+    classifier_version = db.Column(db.String(50))
     
     # Analysis metadata
     processing_status = db.Column(db.String(20), default='uploaded')  # uploaded, processing, completed, failed
@@ -25,9 +36,214 @@ class AnalysisSession(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     completed_at = db.Column(db.DateTime)
     
+    # Same indexes as virtual_ihc_db.sql, so create_all databases match it
+    __table_args__ = (
+        db.Index('idx_session_user', 'user_id'),
+        db.Index('idx_session_status', 'processing_status'),
+        db.Index('idx_session_created', 'created_at'),
+        db.Index('idx_session_classifier_version', 'classifier_version'),
+    )
+    
+    def apply_prediction(self, prediction_results, classifier_version):
+        """
+        Store Phase 2 results as current and keep a per-version copy
+        The copy of a version seen before (e.g. after a rollback) is updated
+        """
+        self.her2_prediction = prediction_results['her2_status']
+        self.confidence_score = prediction_results['confidence']
+        self.cancer_grade = prediction_results['cancer_grade']
+        self.biomarker_percentage = prediction_results['biomarker_percentage']
+        self.staining_intensity = prediction_results['staining_intensity']
+        self.tta_agreement = prediction_results.get('tta_agreement')
+        self.classifier_version = classifier_version
+        
+        result = next((existing for existing in self.classification_results
+                       if existing.classifier_version == classifier_version), None)
+        if result is None:
+            result = ClassificationResult()
+            result.session_id = self.session_id
+            result.classifier_version = classifier_version
+        result.her2_prediction = self.her2_prediction
+        result.confidence_score = self.confidence_score
+        result.cancer_grade = self.cancer_grade
+        result.biomarker_percentage = self.biomarker_percentage
+        result.staining_intensity = self.staining_intensity
+        result.tta_agreement = self.tta_agreement
+        result.positive_cell_count = prediction_results.get('positive_cells')
+        result.total_cell_count = prediction_results.get('total_cells')
+        result.stained_area_percentage = prediction_results.get('stained_area')
+        return result
+    
+    def apply_markers(self, markers, classifier_version):
+        """Build or update one MarkerResult per marker of a panel prediction"""
+        existing = {result.marker: result for result in self.marker_results
+                    if result.classifier_version == classifier_version}
+        marker_results = []
+        for marker in markers:
+            marker_result = existing.pop(marker['marker'], None)
+            if marker_result is None:
+                marker_result = MarkerResult()
+                marker_result.session_id = self.session_id
+                marker_result.classifier_version = classifier_version
+                marker_result.marker = marker['marker']
+            marker_result.status = marker['status']
+            marker_result.percentage = marker['percentage']
+            marker_result.confidence_score = marker['confidence']
+            marker_result.staining_intensity = marker['staining_intensity']
+            marker_results.append(marker_result)
+        # Markers this version no longer reports
+        for stale in existing.values():
+            db.session.delete(stale)
+        return marker_results
+    
+    def apply_stage_memory(self, stages):
+        """Build one StageMemory per stage measured by a MemoryMeter"""
+        stage_rows = []
+        for stage in stages:
+            stage_memory = StageMemory()
+            stage_memory.session_id = self.session_id
+            stage_memory.stage = stage['stage']
+            stage_memory.seconds = stage['seconds']
+            stage_memory.rss_start = stage['rss_start']
+            stage_memory.rss_peak = stage['rss_peak']
+            stage_memory.traced_peak = stage['traced_peak']
+            stage_rows.append(stage_memory)
+        return stage_rows
+    
+    @property
+    def ihc_display_path(self):
+        """The JPEG preview of the IHC image when one was written, else the master"""
+        if self.ihc_image_path:
+            preview = storage.preview_path(self.ihc_image_path)
+            if os.path.exists(preview):
+                return preview
+        return self.ihc_image_path
+    
+    def current_marker_results(self):
+        """Panel results of the classifier version currently shown, in panel order"""
+        return [result for result in self.marker_results if result.classifier_version == self.classifier_version]
+    
     def __repr__(self):
         return f'<AnalysisSession {self.session_id}>'
 
+class ClassificationResult(db.Model):
+    """Phase 2 results per classifier version, kept side by side"""
+    id = db.Column(db.Integer, primary_key=True)
+    session_id = db.Column(db.String(64), db.ForeignKey('analysis_session.session_id'), nullable=False)
+    classifier_version = db.Column(db.String(50), nullable=False)
+    
+    her2_prediction = db.Column(db.String(20))
+    confidence_score = db.Column(db.Float)
+    cancer_grade = db.Column(db.String(10))
+    biomarker_percentage = db.Column(db.Float)
+    staining_intensity = db.Column(db.String(20))
+    tta_agreement = db.Column(db.Float)
+    positive_cell_count = db.Column(db.Integer)
+    total_cell_count = db.Column(db.Integer)
+    stained_area_percentage = db.Column(db.Float)
+    
+    # Report text generated from this version's results
+    report_summary = db.Column(db.Text)
+    report_recommendations = db.Column(db.Text)
+    report_technical_notes = db.Column(db.Text)
+    
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.UniqueConstraint('session_id', 'classifier_version', name='uq_result_session_version'),
+    )
+    
+    # Relationship
+    session = db.relationship('AnalysisSession', backref=db.backref('classification_results', lazy=True))
+    
+    def copy_report(self, report):
+        """Keep this version's copy of the report text"""
+        self.report_summary = report.summary
+        self.report_recommendations = report.recommendations
+        self.report_technical_notes = report.technical_notes
+    
+    def __repr__(self):
+        return f'<ClassificationResult {self.session_id} {self.classifier_version}>'
+
+class MarkerResult(db.Model):
+    """Per-marker results of a multi-marker panel analysis (HER2, ER, PR, Ki-67)"""
+    id = db.Column(db.Integer, primary_key=True)
+    session_id = db.Column(db.String(64), db.ForeignKey('analysis_session.session_id'), nullable=False)
+    classifier_version = db.Column(db.String(50), nullable=False)
+    marker = db.Column(db.String(20), nullable=False)
+    
+    status = db.Column(db.String(20))  # positive, low positive, negative, equivocal; high/low for Ki-67
+    percentage = db.Column(db.Float)
+    confidence_score = db.Column(db.Float)
+    staining_intensity = db.Column(db.String(20))
+    
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.UniqueConstraint('session_id', 'classifier_version', 'marker', name='uq_marker_session_version'),
+    )
+    
+    # Relationship; rows are inserted in panel order
+    session = db.relationship('AnalysisSession', backref=db.backref('marker_results', lazy=True,
+                                                                    order_by='MarkerResult.id'))
+    
+    def __repr__(self):
+        return f'<MarkerResult {self.session_id} {self.marker}>'
+
+class StageMemory(db.Model):
+    """Peak memory of one pipeline stage of a session"""
+    id = db.Column(db.Integer, primary_key=True)
+    session_id = db.Column(db.String(64), db.ForeignKey('analysis_session.session_id'), nullable=False)
+    stage = db.Column(db.String(30), nullable=False)  # upload, conversion, classification, report, report_pdf
+    
+    seconds = db.Column(db.Float)
+    rss_start = db.Column(db.BigInteger)  # process RSS in bytes when the stage started
+    rss_peak = db.Column(db.BigInteger)  # highest process RSS sampled during the stage
+    traced_peak = db.Column(db.BigInteger)  # tracemalloc peak above the stage's start, when tracing
+    
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    # Relationship; rows are inserted in pipeline order
+    session = db.relationship('AnalysisSession', backref=db.backref('stage_memory', lazy=True,
+                                                                    order_by='StageMemory.id'))
+    
+    def __repr__(self):
+        return f'<StageMemory {self.session_id} {self.stage}>'
+
+class SessionFeatures(db.Model):
+    """Feature vector of a session's IHC image, so later analyses skip re-reading it"""
+    id = db.Column(db.Integer, primary_key=True)
+    session_id = db.Column(db.String(64), db.ForeignKey('analysis_session.session_id'), unique=True, nullable=False)
+    feature_version = db.Column(db.String(50), nullable=False)
+    dimension = db.Column(db.Integer, nullable=False)
+    vector = db.Column(db.LargeBinary, nullable=False)  # float32, see features.FEATURE_NAMES
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    # Relationship
+    session = db.relationship('AnalysisSession', backref=db.backref('features', uselist=False, lazy=True))
+    
+    def __repr__(self):
+        return f'<SessionFeatures {self.session_id} {self.feature_version}>'
+
+class ReclassificationJob(db.Model):
+    """Progress of a bulk re-classification run, used to resume it"""
+    id = db.Column(db.Integer, primary_key=True)
+    classifier_version = db.Column(db.String(50), nullable=False)
+    status = db.Column(db.String(20), default='running')  # running, interrupted, completed
+    total_sessions = db.Column(db.Integer, default=0)
+    processed_sessions = db.Column(db.Integer, default=0)
+    failed_sessions = db.Column(db.Integer, default=0)
+    
+    # Highest AnalysisSession.id handled so far; sessions are processed in id order
+    last_session_pk = db.Column(db.Integer, default=0)
+    
+    started_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+    
+    def __repr__(self):
+        return f'<ReclassificationJob {self.id} {self.classifier_version}>'
+
 class ReportData(db.Model):
     """Model to store generated report data"""
     id = db.Column(db.Integer, primary_key=True)
@@ -46,6 +262,10 @@ class ReportData(db.Model):
     
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
+    __table_args__ = (
+        db.Index('idx_report_session', 'session_id'),
+    )
+    
     # Relationship
     session = db.relationship('AnalysisSession', backref=db.backref('reports', lazy=True))
     
@@ -66,6 +286,11 @@ class User(UserMixin, db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     last_login = db.Column(db.DateTime)
     
+    __table_args__ = (
+        db.Index('idx_user_username', 'username'),
+        db.Index('idx_user_email', 'email'),
+    )
+    
     # Relationships
     sessions = db.relationship('AnalysisSession', backref='user', lazy=True)
     
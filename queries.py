@@ -0,0 +1,114 @@
+import time
+import logging
+import threading
+from collections import OrderedDict
+from flask import abort
+from sqlalchemy import event
+from sqlalchemy.orm import Session, joinedload
+from app import db
+from models import AnalysisSession, MarkerResult, ReportData
+
+logger = logging.getLogger(__name__)
+
+class ResultCache:
+    """
+    Read-through LRU cache of completed sessions, loaded with their report,
+    marker results and owner and detached from the database session
+    Entries are dropped when a commit touches the session or its rows, and
+    expire after ttl seconds to bound staleness from other processes
+    """
+
+    def __init__(self, max_entries=512, ttl=300.0):
+        """Initialize the cache size and entry lifetime"""
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_id):
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None:
+                return None
+            if time.monotonic() - entry[0] > self.ttl:
+                del self._entries[session_id]
+                return None
+            self._entries.move_to_end(session_id)
+            return entry[1]
+
+    def put(self, session_id, analysis_session):
+        with self._lock:
+            self._entries[session_id] = (time.monotonic(), analysis_session)
+            self._entries.move_to_end(session_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, session_ids):
+        with self._lock:
+            for session_id in session_ids:
+                self._entries.pop(session_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+result_cache = ResultCache()
+
+def init_app(app):
+    """Size the result cache from the application config"""
+    result_cache.max_entries = app.config.get('RESULT_CACHE_SIZE', 512)
+    result_cache.ttl = app.config.get('RESULT_CACHE_TTL', 300.0)
+    result_cache.clear()
+
+def _load_session(session_id):
+    """One SELECT for the session, its owner, reports and marker results"""
+    return AnalysisSession.query.options(
+        joinedload(AnalysisSession.user),
+        joinedload(AnalysisSession.reports),
+        joinedload(AnalysisSession.marker_results)
+    ).filter_by(session_id=session_id).first()
+
+def get_user_session(session_id, user_id):
+    """
+    Return (session, report) for a session owned by user_id, or abort with 404
+    Completed sessions come from the cache when possible, so a page render
+    needs at most one database round trip for its data
+    """
+    analysis_session = result_cache.get(session_id)
+    if analysis_session is None:
+        analysis_session = _load_session(session_id)
+        if analysis_session is not None and analysis_session.processing_status == 'completed':
+            # Detach, with the loaded owner and children, so later commits in this
+            # request cannot expire the cached copy
+            for related in [analysis_session.user] + analysis_session.reports + analysis_session.marker_results:
+                db.session.expunge(related)
+            db.session.expunge(analysis_session)
+            result_cache.put(session_id, analysis_session)
+
+    if analysis_session is None or analysis_session.user_id != user_id:
+        abort(404)
+
+    reports = sorted(analysis_session.reports, key=lambda report: report.id)
+    return analysis_session, reports[0] if reports else None
+
+def _affected_session_ids(session):
+    """Session IDs of the analysis rows a flush is about to change"""
+    session_ids = set()
+    for instance in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(instance, (AnalysisSession, ReportData, MarkerResult)):
+            session_ids.add(instance.session_id)
+    return session_ids
+
+@event.listens_for(Session, 'before_flush')
+def _collect_changes(session, flush_context, instances):
+    session.info.setdefault('result_cache_invalidate', set()).update(_affected_session_ids(session))
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_committed(session):
+    session_ids = session.info.pop('result_cache_invalidate', None)
+    if session_ids:
+        result_cache.invalidate(session_ids)
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard_changes(session, previous_transaction):
+    session.info.pop('result_cache_invalidate', None)
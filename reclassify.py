@@ -0,0 +1,149 @@
+import os
+import logging
+from datetime import datetime
+from sqlalchemy import or_
+from flask import current_app
+from app import db
+from models import AnalysisSession, ClassificationResult, ReclassificationJob, ReportData
+from model_registry import get_array_store
+import storage
+
+logger = logging.getLogger(__name__)
+
+# Version recorded for results stored before classifier versions were tracked
+UNVERSIONED = 'unversioned'
+
+def stale_sessions_query(classifier_version):
+    """Completed sessions whose stored results come from another classifier version"""
+    return AnalysisSession.query.filter(
+        AnalysisSession.processing_status == 'completed',
+        AnalysisSession.ihc_image_path.isnot(None),
+        or_(AnalysisSession.classifier_version.is_(None),
+            AnalysisSession.classifier_version != classifier_version)
+    )
+
+def get_or_create_job(classifier_version):
+    """Resume the unfinished job for this version, or start a new one"""
+    job = ReclassificationJob.query.filter(
+        ReclassificationJob.classifier_version == classifier_version,
+        ReclassificationJob.status != 'completed'
+    ).order_by(ReclassificationJob.id.desc()).first()
+
+    if job is None:
+        job = ReclassificationJob()
+        job.classifier_version = classifier_version
+        job.total_sessions = stale_sessions_query(classifier_version).count()
+        job.processed_sessions = 0
+        job.failed_sessions = 0
+        job.last_session_pk = 0
+        db.session.add(job)
+    else:
+        logger.info("Resuming re-classification job %s after session pk %s", job.id, job.last_session_pk)
+
+    job.status = 'running'
+    db.session.commit()
+    return job
+
+def _snapshot_previous(analysis_session):
+    """Keep results from before versioning so they survive being replaced"""
+    previous_version = analysis_session.classifier_version or UNVERSIONED
+    exists = ClassificationResult.query.filter_by(
+        session_id=analysis_session.session_id,
+        classifier_version=previous_version
+    ).first()
+    if exists:
+        return
+
+    report = ReportData.query.filter_by(session_id=analysis_session.session_id).first()
+    previous = analysis_session.apply_prediction({
+        'her2_status': analysis_session.her2_prediction,
+        'confidence': analysis_session.confidence_score,
+        'cancer_grade': analysis_session.cancer_grade,
+        'biomarker_percentage': analysis_session.biomarker_percentage,
+        'staining_intensity': analysis_session.staining_intensity,
+        'tta_agreement': analysis_session.tta_agreement,
+        'positive_cells': report.positive_cell_count if report else None,
+        'total_cells': report.total_cell_count if report else None,
+        'stained_area': report.stained_area_percentage if report else None
+    }, previous_version)
+    if report:
+        previous.copy_report(report)
+    db.session.add(previous)
+
+def reclassify_session(classifier, analysis_session):
+    """Run Phase 2 only, on the IHC image already stored for the session"""
+    from routes import generate_summary, generate_recommendations, generate_technical_notes
+
+    if not os.path.exists(analysis_session.ihc_image_path):
+        raise FileNotFoundError(f"IHC image missing: {analysis_session.ihc_image_path}")
+
+    # Sessions analysed with the full marker panel are re-scored with it
+    panel = bool(analysis_session.marker_results)
+    _snapshot_previous(analysis_session)
+    heatmap_path = storage.shard_path(current_app.config['GENERATED_FOLDER'],
+                                      f"{analysis_session.session_id}_her2_heatmap.png")
+    image = get_array_store().load_image(analysis_session.session_id, 'ihc',
+                                         analysis_session.ihc_image_path, classifier.load_image)
+    prediction_results = classifier.predict(analysis_session.ihc_image_path, panel=panel, heatmap_path=heatmap_path,
+                                            image=image)
+    prediction_results.pop('features', None)
+    analysis_session.heatmap_image_path = prediction_results.pop('heatmap_path', None)
+    markers = prediction_results.pop('markers', [])
+    classification_result = analysis_session.apply_prediction(prediction_results, classifier.version)
+    db.session.add(classification_result)
+    db.session.add_all(analysis_session.apply_markers(markers, classifier.version))
+
+    report = ReportData.query.filter_by(session_id=analysis_session.session_id).first()
+    if report:
+        # The text states the HER2 call and its recommendations, so it follows the new results
+        report.positive_cell_count = prediction_results.get('positive_cells', 0)
+        report.total_cell_count = prediction_results.get('total_cells', 0)
+        report.stained_area_percentage = prediction_results.get('stained_area', 0.0)
+        report.summary = generate_summary(analysis_session)
+        report.recommendations = generate_recommendations(analysis_session)
+        report.technical_notes = generate_technical_notes(analysis_session)
+        classification_result.copy_report(report)
+
+def run_reclassification(classifier, batch_size=50, limit=None):
+    """Re-classify stale sessions in id-ordered batches, committing progress per batch"""
+    job = get_or_create_job(classifier.version)
+    handled = 0
+
+    try:
+        while limit is None or handled < limit:
+            size = batch_size if limit is None else min(batch_size, limit - handled)
+            batch = stale_sessions_query(classifier.version).filter(
+                AnalysisSession.id > job.last_session_pk
+            ).order_by(AnalysisSession.id).limit(size).all()
+            if not batch:
+                job.status = 'completed'
+                job.finished_at = datetime.utcnow()
+                break
+
+            for analysis_session in batch:
+                try:
+                    # A failing session rolls back to its savepoint, not the whole batch
+                    with db.session.begin_nested():
+                        reclassify_session(classifier, analysis_session)
+                    job.processed_sessions += 1
+                except Exception as e:
+                    logger.error("Re-classification failed for %s: %s", analysis_session.session_id, e)
+                    job.failed_sessions += 1
+                job.last_session_pk = analysis_session.id
+                handled += 1
+
+            job.updated_at = datetime.utcnow()
+            db.session.commit()
+            logger.info("Re-classification job %s: %s/%s done", job.id, job.processed_sessions, job.total_sessions)
+        else:
+            job.status = 'interrupted'
+    except BaseException:
+        # Keep the progress of completed batches; the current batch is retried on resume
+        db.session.rollback()
+        job.status = 'interrupted'
+        db.session.commit()
+        raise
+
+    job.updated_at = datetime.utcnow()
+    db.session.commit()
+    return job
@@ -1,34 +1,67 @@
-import os
 import uuid
 from datetime import datetime
-from flask import render_template, request, redirect, url_for, flash, jsonify, send_file
+from flask import current_app, render_template, request, redirect, url_for, flash, jsonify, send_file
 from flask_login import login_user, login_required, logout_user, current_user
 from werkzeug.utils import secure_filename
-from app import app, db
-from models import AnalysisSession, ReportData, User
-from ml_models import HEToIHCConverter, CancerClassifier
+from app import db
+from models import AnalysisSession, ReportData, SessionFeatures, StageMemory, User
+from model_registry import (get_converter, get_classifier, get_similarity_index, get_array_store,
+                            get_image_writer, get_memory_budget)
 from utils import allowed_file, process_image, generate_report_pdf
+from queries import get_user_session
+import storage
+from logging_setup import bind_log_context
+from memory_budget import MemoryMeter, estimate_footprint
 import logging
 
-# Initialize ML models
-he_to_ihc_converter = HEToIHCConverter()
-cancer_classifier = CancerClassifier()
+logger = logging.getLogger(__name__)
 
-@app.route('/')
+# Views are registered on the application by init_app
+_url_rules = []
+_error_handlers = []
+
+def route(rule, **options):
+    """Record a view for registration, like app.route"""
+    def decorator(view):
+        _url_rules.append((rule, view, options))
+        return view
+    return decorator
+
+def errorhandler(code):
+    """Record an error handler for registration, like app.errorhandler"""
+    def decorator(handler):
+        _error_handlers.append((code, handler))
+        return handler
+    return decorator
+
+def init_app(app):
+    """Register all views and error handlers on the application"""
+    for rule, view, options in _url_rules:
+        app.add_url_rule(rule, view.__name__, view, **options)
+    for code, handler in _error_handlers:
+        app.register_error_handler(code, handler)
+
+@route('/')
 def index():
     """Home page with project overview"""
     return render_template('index.html')
 
-@app.route('/upload')
+@route('/upload')
 @login_required
 def upload_page():
     """Upload page for H&E stained slides"""
-    return render_template('upload.html')
+    normalizer = get_converter().stain_normalizer
+    stain_profiles = normalizer.available_profiles() if normalizer else []
+    return render_template('upload.html', stain_profiles=stain_profiles)
 
-@app.route('/process_image', methods=['POST'])
+@route('/process_image', methods=['POST'])
 @login_required
 def process_image_route():
     """Process uploaded H&E image through the two-phase pipeline"""
+    from features import FEATURE_VERSION, pack_vector
+    
+    budget = get_memory_budget()
+    memory_estimate = None
     try:
         if 'he_image' not in request.files:
             flash('No file selected', 'error')
@@ -43,13 +76,44 @@ def process_image_route():
             flash('Invalid file format. Please upload TIFF, PNG, or JPEG images.', 'error')
             return redirect(url_for('upload_page'))
         
+        # Lab/scanner stain profile; unknown names fall back to per-image estimation
+        stain_profile = request.form.get('stain_profile') or None
+        he_to_ihc_converter = get_converter()
+        cancer_classifier = get_classifier()
+        normalizer = he_to_ihc_converter.stain_normalizer
+        if stain_profile and (normalizer is None or stain_profile not in normalizer.available_profiles()):
+            stain_profile = None
+        
+        # 'panel' scores HER2, ER, PR and Ki-67 from the same preprocessing pass
+        panel = request.form.get('analysis_mode') == 'panel'
+        
+        # Expected peak memory from the image header, read before anything is saved
+        try:
+            footprint = estimate_footprint(file.stream, he_to_ihc_converter.input_size)
+        except Exception as e:
+            logger.warning("Unreadable image header: %s", e)
+            flash('Could not read the uploaded image', 'error')
+            return redirect(url_for('upload_page'))
+        finally:
+            file.stream.seek(0)
+        
+        # Wait for room in the memory budget; turn the upload away if none frees up
+        if not budget.acquire(footprint, timeout=current_app.config['MEMORY_ADMISSION_TIMEOUT']):
+            logger.warning("Analysis deferred: %s bytes do not fit in the memory budget", footprint)
+            flash('The server is busy with other analyses. Please try again in a few minutes.', 'error')
+            return redirect(url_for('upload_page'))
+        memory_estimate = footprint
+        meter = MemoryMeter()
+        
         # Generate unique session ID
         session_id = str(uuid.uuid4())
+        bind_log_context(session_id=session_id, phase='upload')
         
         # Save uploaded file
         filename = secure_filename(file.filename or 'image')
-        he_image_path = os.path.join(app.config['UPLOAD_FOLDER'], f"{session_id}_{filename}")
-        file.save(he_image_path)
+        he_image_path = storage.shard_path(current_app.config['UPLOAD_FOLDER'], f"{session_id}_{filename}")
+        with meter.stage('upload'):
+            file.save(he_image_path)
         
         # Create analysis session record
         analysis_session = AnalysisSession()
@@ -58,83 +122,138 @@ def process_image_route():
         analysis_session.original_filename = filename
         analysis_session.he_image_path = he_image_path
         analysis_session.processing_status = 'processing'
+        analysis_session.memory_estimate = memory_estimate
         db.session.add(analysis_session)
         db.session.commit()
         
-        logging.info(f"Starting analysis for session {session_id}")
+        logger.info("Starting analysis for session %s", session_id)
         
         # Phase 1: H&E to IHC conversion
-        logging.info("Phase 1: Converting H&E to virtual IHC")
-        ihc_image_path = os.path.join(app.config['GENERATED_FOLDER'], f"{session_id}_ihc.png")
+        bind_log_context(phase='conversion')
+        logger.info("Phase 1: Converting H&E to virtual IHC")
+        ihc_image_path = storage.shard_path(current_app.config['GENERATED_FOLDER'],
+                                            f"{session_id}_ihc{he_to_ihc_converter.output_extension}")
         
         try:
-            he_to_ihc_converter.convert(he_image_path, ihc_image_path)
-            analysis_session.ihc_image_path = ihc_image_path
-            logging.info("Phase 1 completed successfully")
+            with meter.stage('conversion'):
+                ihc_image = he_to_ihc_converter.convert(he_image_path, ihc_image_path, stain_profile=stain_profile)
+                analysis_session.ihc_image_path = ihc_image_path
+                
+                # Later stages and re-analyses map the decoded result instead of re-reading the PNG
+                try:
+                    ihc_image = get_array_store().put(session_id, 'ihc', ihc_image)
+                except OSError as e:
+                    logger.warning("Array store unavailable, keeping IHC in memory: %s", e)
+            analysis_session.converter_version = he_to_ihc_converter.version
+            logger.info("Phase 1 completed successfully")
         except Exception as e:
-            logging.error(f"Phase 1 failed: {str(e)}")
+            logger.error("Phase 1 failed: %s", e)
             analysis_session.processing_status = 'failed'
             analysis_session.error_message = f"IHC generation failed: {str(e)}"
+            db.session.add_all(analysis_session.apply_stage_memory(meter.stages))
             db.session.commit()
             flash('Image processing failed during IHC generation', 'error')
             return redirect(url_for('upload_page'))
         
         # Phase 2: Cancer severity prediction
-        logging.info("Phase 2: Analyzing cancer severity")
+        bind_log_context(phase='classification')
+        logger.info("Phase 2: Analyzing cancer severity")
+        features = None
         try:
-            prediction_results = cancer_classifier.predict(ihc_image_path)
+            heatmap_path = storage.shard_path(current_app.config['GENERATED_FOLDER'], f"{session_id}_her2_heatmap.png")
+            with meter.stage('classification'):
+                prediction_results = cancer_classifier.predict(ihc_image_path, panel=panel, heatmap_path=heatmap_path,
+                                                               image=ihc_image)
+            markers = prediction_results.pop('markers', [])
+            analysis_session.heatmap_image_path = prediction_results.pop('heatmap_path', None)
             
             # Update analysis session with results
-            analysis_session.her2_prediction = prediction_results['her2_status']
-            analysis_session.confidence_score = prediction_results['confidence']
-            analysis_session.cancer_grade = prediction_results['cancer_grade']
-            analysis_session.biomarker_percentage = prediction_results['biomarker_percentage']
-            analysis_session.staining_intensity = prediction_results['staining_intensity']
+            classification_result = analysis_session.apply_prediction(prediction_results, cancer_classifier.version)
+            db.session.add(classification_result)
+            db.session.add_all(analysis_session.apply_markers(markers, cancer_classifier.version))
             analysis_session.processing_status = 'completed'
             analysis_session.completed_at = datetime.utcnow()
             
-            logging.info("Phase 2 completed successfully")
+            # Store the feature vector so later analyses need not re-read the image
+            features = prediction_results.pop('features', None)
+            if features is not None:
+                session_features = SessionFeatures()
+                session_features.session_id = session_id
+                session_features.feature_version = FEATURE_VERSION
+                session_features.dimension = len(features)
+                session_features.vector = pack_vector(features)
+                db.session.add(session_features)
+            
+            logger.info("Phase 2 completed successfully")
             
         except Exception as e:
-            logging.error(f"Phase 2 failed: {str(e)}")
+            logger.error("Phase 2 failed: %s", e)
             analysis_session.processing_status = 'failed'
             analysis_session.error_message = f"Cancer prediction failed: {str(e)}"
+            db.session.add_all(analysis_session.apply_stage_memory(meter.stages))
             db.session.commit()
             flash('Image processing failed during cancer analysis', 'error')
             return redirect(url_for('upload_page'))
         
         # Generate report data
+        bind_log_context(phase='report')
         try:
-            report_data = ReportData()
-            report_data.session_id = session_id
-            report_data.report_type = 'diagnostic'
-            report_data.summary = generate_summary(analysis_session)
-            report_data.recommendations = generate_recommendations(analysis_session)
-            report_data.technical_notes = generate_technical_notes(analysis_session)
+            with meter.stage('report'):
+                report_data = ReportData()
+                report_data.session_id = session_id
+                report_data.report_type = 'diagnostic'
+                report_data.summary = generate_summary(analysis_session)
+                report_data.recommendations = generate_recommendations(analysis_session)
+                report_data.technical_notes = generate_technical_notes(analysis_session)
             report_data.positive_cell_count = prediction_results.get('positive_cells', 0)
             report_data.total_cell_count = prediction_results.get('total_cells', 0)
             report_data.stained_area_percentage = prediction_results.get('stained_area', 0.0)
             db.session.add(report_data)
+            classification_result.copy_report(report_data)
             
         except Exception as e:
-            logging.error(f"Report generation failed: {str(e)}")
+            logger.error("Report generation failed: %s", e)
             # Continue without failing the entire process
             
+        # The results page links the IHC image, and may be served by another
+        # worker that cannot wait on this process's writer
+        try:
+            get_image_writer().wait(ihc_image_path, timeout=30)
+        except Exception as e:
+            logger.error("Writing the IHC image failed: %s", e)
+            analysis_session.processing_status = 'failed'
+            analysis_session.error_message = f"Saving the IHC image failed: {str(e)}"
+            db.session.add_all(analysis_session.apply_stage_memory(meter.stages))
+            db.session.commit()
+            flash('Image processing failed while saving the IHC image', 'error')
+            return redirect(url_for('upload_page'))
+        
+        db.session.add_all(analysis_session.apply_stage_memory(meter.stages))
         db.session.commit()
+        
+        # Make the completed session findable by similar-case search
+        if features is not None:
+            try:
+                get_similarity_index().add(analysis_session.id, features)
+            except Exception as e:
+                logger.error("Similarity index update failed: %s", e)
+        
         flash('Analysis completed successfully!', 'success')
         return redirect(url_for('results', session_id=session_id))
         
     except Exception as e:
-        logging.error(f"Unexpected error in process_image_route: {str(e)}")
+        logger.error("Unexpected error in process_image_route: %s", e)
         flash('An unexpected error occurred during processing', 'error')
         return redirect(url_for('upload_page'))
+    finally:
+        if memory_estimate is not None:
+            budget.release(memory_estimate)
 
-@app.route('/results/<session_id>')
+@route('/results/<session_id>')
 @login_required
 def results(session_id):
     """Display analysis results"""
-    session = AnalysisSession.query.filter_by(session_id=session_id, user_id=current_user.id).first_or_404()
-    report = ReportData.query.filter_by(session_id=session_id).first()
+    session, report = get_user_session(session_id, current_user.id)
     
     if session.processing_status == 'processing':
         flash('Analysis is still in progress. Please wait...', 'info')
@@ -146,12 +265,11 @@ def results(session_id):
     
     return render_template('results.html', session=session, report=report)
 
-@app.route('/report/<session_id>')
+@route('/report/<session_id>')
 @login_required
 def report(session_id):
     """Display detailed diagnostic report"""
-    session = AnalysisSession.query.filter_by(session_id=session_id, user_id=current_user.id).first_or_404()
-    report = ReportData.query.filter_by(session_id=session_id).first()
+    session, report = get_user_session(session_id, current_user.id)
     
     if not report:
         flash('Report not available for this session', 'error')
@@ -159,26 +277,68 @@ def report(session_id):
     
     return render_template('report.html', session=session, report=report)
 
-@app.route('/download_report/<session_id>')
+@route('/download_report/<session_id>')
 @login_required
 def download_report(session_id):
     """Download PDF report"""
-    session = AnalysisSession.query.filter_by(session_id=session_id, user_id=current_user.id).first_or_404()
-    report = ReportData.query.filter_by(session_id=session_id).first()
+    session, report = get_user_session(session_id, current_user.id)
     
     if not report:
         flash('Report not available for download', 'error')
         return redirect(url_for('results', session_id=session_id))
     
     try:
-        pdf_path = generate_report_pdf(session, report)
+        meter = MemoryMeter()
+        with meter.stage('report_pdf'):
+            pdf_path = generate_report_pdf(session, report)
+        
+        # Account the first render; later downloads regenerate the same document
+        if not StageMemory.query.filter_by(session_id=session_id, stage='report_pdf').first():
+            db.session.add_all(session.apply_stage_memory(meter.stages))
+            db.session.commit()
         return send_file(pdf_path, as_attachment=True, 
                         download_name=f"diagnostic_report_{session_id}.pdf")
     except Exception as e:
-        logging.error(f"PDF generation failed: {str(e)}")
+        logger.error("PDF generation failed: %s", e)
         flash('Failed to generate PDF report', 'error')
         return redirect(url_for('report', session_id=session_id))
 
+@route('/similar_cases/<session_id>')
+@login_required
+def similar_cases(session_id):
+    """Return the user's past cases whose images look most like this session"""
+    from features import FEATURE_VERSION, unpack_vector
+    
+    session = AnalysisSession.query.filter_by(session_id=session_id, user_id=current_user.id).first_or_404()
+    session_features = SessionFeatures.query.filter_by(session_id=session_id).first()
+    if not session_features or session_features.feature_version != FEATURE_VERSION:
+        return jsonify({'session_id': session_id, 'similar_cases': []})
+    
+    k = min(max(request.args.get('k', 5, type=int), 1), 50)
+    
+    # Over-fetch because neighbours owned by other users are filtered out
+    neighbours = get_similarity_index().search(unpack_vector(session_features.vector), k=k * 5, exclude=session.id)
+    distances = dict(neighbours)
+    candidates = AnalysisSession.query.filter(
+        AnalysisSession.id.in_(list(distances)),
+        AnalysisSession.user_id == current_user.id,
+        AnalysisSession.processing_status == 'completed'
+    ).all()
+    candidates.sort(key=lambda candidate: distances[candidate.id])
+    
+    return jsonify({
+        'session_id': session_id,
+        'similar_cases': [{
+            'session_id': candidate.session_id,
+            'original_filename': candidate.original_filename,
+            'her2_prediction': candidate.her2_prediction,
+            'cancer_grade': candidate.cancer_grade,
+            'created_at': candidate.created_at.isoformat() if candidate.created_at else None,
+            'distance': distances[candidate.id],
+            'url': url_for('results', session_id=candidate.session_id)
+        } for candidate in candidates[:k]]
+    })
+
 def generate_summary(session):
     """Generate diagnostic summary"""
     her2_status = session.her2_prediction or "Not determined"
@@ -245,23 +405,26 @@ def generate_technical_notes(session):
     • Artifact level: Minimal
     """
 
-@app.errorhandler(413)
+@errorhandler(413)
 def too_large(e):
     flash('File too large. Maximum size is 16MB.', 'error')
     return redirect(url_for('upload_page'))
 
-@app.route('/static/uploads/<filename>')
+@route('/static/uploads/<filename>')
 def uploaded_file(filename):
     """Serve uploaded images"""
-    return send_file(os.path.join(app.config['UPLOAD_FOLDER'], filename))
+    return send_file(storage.resolve_path(current_app.config['UPLOAD_FOLDER'], filename))
 
-@app.route('/static/generated/<filename>')
+@route('/static/generated/<filename>')
 def generated_file(filename):
     """Serve generated images"""
-    return send_file(os.path.join(app.config['GENERATED_FOLDER'], filename))
+    path = storage.resolve_path(current_app.config['GENERATED_FOLDER'], filename)
+    # The IHC image may still be in this process's background writer
+    get_image_writer().wait(path, timeout=30)
+    return send_file(path)
 
 # Authentication routes
-@app.route('/login', methods=['GET', 'POST'])
+@route('/login', methods=['GET', 'POST'])
 def login():
     """User login"""
     if current_user.is_authenticated:
@@ -291,7 +454,7 @@ def login():
     
     return render_template('login.html')
 
-@app.route('/register', methods=['GET', 'POST'])
+@route('/register', methods=['GET', 'POST'])
 def register():
     """User registration"""
     if current_user.is_authenticated:
@@ -348,7 +511,7 @@ def register():
     
     return render_template('register.html')
 
-@app.route('/logout')
+@route('/logout')
 @login_required
 def logout():
     """User logout"""
@@ -356,7 +519,7 @@ def logout():
     flash('You have been logged out', 'info')
     return redirect(url_for('index'))
 
-@app.route('/dashboard')
+@route('/dashboard')
 @login_required
 def dashboard():
     """User dashboard"""
@@ -377,12 +540,12 @@ def dashboard():
     
     return render_template('dashboard.html', sessions=sessions, stats=stats)
 
-@app.route('/profile')
+@route('/profile')
 @login_required
 def profile():
     """User profile page"""
     return render_template('profile.html')
 
-@app.errorhandler(404)
+@errorhandler(404)
 def not_found(e):
     return render_template('index.html'), 404
@@ -9,7 +9,9 @@ import sys
 # Add current directory to Python path
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
-from app import app
+from app import create_app
+
+app = create_app()
 
 if __name__ == '__main__':
     print("Starting Virtual IHC Analysis System...")
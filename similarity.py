@@ -0,0 +1,255 @@
+import os
+import fcntl
+import logging
+import threading
+from contextlib import contextmanager
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+class CaseIndex:
+    """
+    Approximate nearest-neighbour index over per-session feature vectors
+    Vectors, session keys and IVF list assignments are append-only files that
+    are memory-mapped for queries; coarse centroids are trained with k-means
+    once enough sessions exist, after which queries scan only n_probe lists.
+    The centroids are retrained whenever the index has grown retrain_factor
+    times past the size they were trained on
+    """
+
+    VECTORS_FILE = 'vectors.f32'
+    IDS_FILE = 'ids.i64'
+    LISTS_FILE = 'lists.i32'
+    META_FILE = 'meta.npz'
+    VERSION_FILE = 'version.txt'
+    LOCK_FILE = '.lock'
+
+    def __init__(self, directory, dimension, version, n_lists=256, n_probe=8,
+                 train_threshold=2048, train_sample=20000, kmeans_iterations=20, retrain_factor=4.0):
+        """Open (or create) the index stored in directory"""
+        self.directory = directory
+        self.dimension = dimension
+        self.version = version
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.train_threshold = train_threshold
+        self.train_sample = train_sample
+        self.kmeans_iterations = kmeans_iterations
+        self.retrain_factor = retrain_factor
+
+        os.makedirs(directory, exist_ok=True)
+        self._thread_lock = threading.Lock()
+        self._maps = {}
+        self._meta = None
+        self._meta_mtime = None
+        self._check_version()
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    @contextmanager
+    def _locked(self, exclusive=True):
+        """Serialize writers across threads and forked worker processes"""
+        with self._thread_lock, open(self._path(self.LOCK_FILE), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _check_version(self):
+        """Discard an index built from a different feature version or dimension"""
+        expected = f"{self.version}:{self.dimension}"
+        path = self._path(self.VERSION_FILE)
+        if os.path.exists(path):
+            with open(path) as handle:
+                if handle.read().strip() == expected:
+                    return
+            logger.info("Similarity index version changed, clearing %s", self.directory)
+        self.clear()
+        with open(path, 'w') as handle:
+            handle.write(expected)
+
+    def clear(self):
+        """Remove every stored vector and the trained centroids"""
+        with self._locked():
+            for name in (self.VECTORS_FILE, self.IDS_FILE, self.LISTS_FILE, self.META_FILE):
+                if os.path.exists(self._path(name)):
+                    os.remove(self._path(name))
+            self._maps = {}
+            self._meta = None
+            self._meta_mtime = None
+
+    def _load_meta(self):
+        """Return centroids and standardization statistics, reloading after training elsewhere"""
+        path = self._path(self.META_FILE)
+        if not os.path.exists(path):
+            self._meta = None
+            return None
+        mtime = os.path.getmtime(path)
+        if self._meta is None or mtime != self._meta_mtime:
+            with np.load(path) as data:
+                self._meta = {key: data[key] for key in data.files}
+            self._meta_mtime = mtime
+        return self._meta
+
+    def _map(self, name, dtype, columns=1):
+        """Memory-map an append-only file, re-mapping when it has grown or been replaced"""
+        path = self._path(name)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return np.empty((0, columns) if columns > 1 else 0, dtype=dtype)
+        # Training replaces the list file with one of the same size
+        key = (stat.st_ino, stat.st_size)
+        cached = self._maps.get(name)
+        if cached is None or cached[0] != key:
+            rows = stat.st_size // (np.dtype(dtype).itemsize * columns)
+            if rows == 0:
+                return np.empty((0, columns) if columns > 1 else 0, dtype=dtype)
+            shape = (rows, columns) if columns > 1 else (rows,)
+            cached = (key, np.memmap(path, dtype=dtype, mode='r', shape=shape))
+            self._maps[name] = cached
+        return cached[1]
+
+    def _arrays(self):
+        """Vectors, ids and list assignments truncated to the rows all three hold"""
+        vectors = self._map(self.VECTORS_FILE, np.float32, self.dimension)
+        ids = self._map(self.IDS_FILE, np.int64)
+        lists = self._map(self.LISTS_FILE, np.int32)
+        rows = min(len(vectors), len(ids), len(lists))
+        return vectors[:rows], ids[:rows], lists[:rows]
+
+    def __len__(self):
+        return len(self._arrays()[1])
+
+    def _standardize(self, vectors, meta):
+        return (vectors - meta['mean']) / meta['std']
+
+    def _assign(self, vectors, meta):
+        """Nearest centroid for each row of vectors"""
+        standardized = self._standardize(vectors, meta)
+        centroids = meta['centroids']
+        distances = ((standardized ** 2).sum(axis=1)[:, np.newaxis]
+                     - 2.0 * standardized @ centroids.T
+                     + (centroids ** 2).sum(axis=1)[np.newaxis, :])
+        return np.argmin(distances, axis=1).astype(np.int32)
+
+    def add(self, session_pk, vector):
+        """Append one session's vector, assigning it to its IVF list when trained"""
+        self.add_batch([session_pk], np.asarray(vector, dtype=np.float32).reshape(1, self.dimension))
+
+    def add_batch(self, session_pks, vectors):
+        """Append several sessions' vectors in one write per file"""
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dimension)
+        with self._locked():
+            meta = self._load_meta()
+            if meta is not None:
+                assignments = self._assign(vectors, meta)
+            else:
+                assignments = np.full(len(vectors), -1, dtype=np.int32)
+
+            # ids are written last so readers never see a key without its vector
+            with open(self._path(self.VECTORS_FILE), 'ab') as handle:
+                handle.write(vectors.tobytes())
+            with open(self._path(self.LISTS_FILE), 'ab') as handle:
+                handle.write(assignments.tobytes())
+            with open(self._path(self.IDS_FILE), 'ab') as handle:
+                handle.write(np.asarray(session_pks, dtype=np.int64).tobytes())
+
+        if self._needs_training(meta, len(self)):
+            self.train()
+
+    def _needs_training(self, meta, rows):
+        """Train first at train_threshold rows, then after each retrain_factor growth"""
+        if meta is None:
+            return rows >= self.train_threshold
+        trained_rows = int(meta['trained_rows']) if 'trained_rows' in meta else self.train_threshold
+        return rows >= trained_rows * self.retrain_factor
+
+    def train(self):
+        """Fit k-means centroids on a sample and reassign every stored vector"""
+        with self._locked():
+            vectors, ids, lists = self._arrays()
+            if len(vectors) == 0:
+                return
+
+            rng = np.random.default_rng(0)
+            sample_rows = rng.choice(len(vectors), size=min(self.train_sample, len(vectors)), replace=False)
+            sample = np.asarray(vectors[np.sort(sample_rows)], dtype=np.float32)
+
+            mean = sample.mean(axis=0)
+            std = sample.std(axis=0)
+            std[std < 1e-6] = 1.0
+            standardized = (sample - mean) / std
+
+            n_lists = min(self.n_lists, len(sample))
+            centroids = standardized[rng.choice(len(standardized), size=n_lists, replace=False)]
+            for _ in range(self.kmeans_iterations):
+                distances = ((standardized ** 2).sum(axis=1)[:, np.newaxis]
+                             - 2.0 * standardized @ centroids.T
+                             + (centroids ** 2).sum(axis=1)[np.newaxis, :])
+                labels = np.argmin(distances, axis=1)
+                counts = np.bincount(labels, minlength=n_lists).astype(np.float32)
+                sums = np.zeros_like(centroids)
+                np.add.at(sums, labels, standardized)
+                nonempty = counts > 0
+                centroids[nonempty] = sums[nonempty] / counts[nonempty, np.newaxis]
+
+            meta = {
+                'centroids': centroids.astype(np.float32),
+                'mean': mean.astype(np.float32),
+                'std': std.astype(np.float32),
+                'trained_rows': np.int64(len(vectors))
+            }
+
+            # Reassign in chunks so memory stays bounded for large indexes
+            assignments = np.empty(len(vectors), dtype=np.int32)
+            for start in range(0, len(vectors), 65536):
+                chunk = np.asarray(vectors[start:start + 65536])
+                assignments[start:start + len(chunk)] = self._assign(chunk, meta)
+
+            lists_path = self._path(self.LISTS_FILE)
+            assignments.tofile(lists_path + '.tmp')
+            os.replace(lists_path + '.tmp', lists_path)
+            with open(self._path('meta.tmp.npz'), 'wb') as handle:
+                np.savez(handle, **meta)
+            os.replace(self._path('meta.tmp.npz'), self._path(self.META_FILE))
+            self._maps.pop(self.LISTS_FILE, None)
+
+        logger.info("Similarity index trained: %s vectors, %s lists", len(vectors), n_lists)
+
+    def search(self, vector, k=10, exclude=None):
+        """Return [(session_pk, distance)] for the k nearest stored vectors"""
+        vector = np.asarray(vector, dtype=np.float32).reshape(1, self.dimension)
+        vectors, ids, lists = self._arrays()
+        if len(ids) == 0:
+            return []
+
+        meta = self._load_meta()
+        if meta is None:
+            # Small untrained index: exact search standardized by the stored data
+            candidates = np.arange(len(ids))
+            mean = vectors.mean(axis=0)
+            std = vectors.std(axis=0)
+            std[std < 1e-6] = 1.0
+            meta = {'mean': mean, 'std': std}
+        else:
+            standardized_query = self._standardize(vector, meta)
+            centroid_distances = ((meta['centroids'] - standardized_query) ** 2).sum(axis=1)
+            n_probe = min(self.n_probe, len(centroid_distances))
+            probes = np.argpartition(centroid_distances, n_probe - 1)[:n_probe]
+            # Rows added before training but not yet reassigned stay searchable
+            candidates = np.flatnonzero(np.isin(lists, probes) | (lists < 0))
+
+        if exclude is not None:
+            candidates = candidates[ids[candidates] != exclude]
+        if len(candidates) == 0:
+            return []
+
+        candidate_vectors = self._standardize(np.asarray(vectors[candidates]), meta)
+        distances = ((candidate_vectors - self._standardize(vector, meta)) ** 2).sum(axis=1)
+        k = min(k, len(candidates))
+        nearest = np.argpartition(distances, k - 1)[:k]
+        nearest = nearest[np.argsort(distances[nearest])]
+        return [(int(ids[candidates[i]]), float(np.sqrt(distances[i]))) for i in nearest]
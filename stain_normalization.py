@@ -0,0 +1,168 @@
+import os
+import logging
+import threading
+import numpy as np
+import cv2
+from quantification import OD_LOOKUP
+
+logger = logging.getLogger(__name__)
+
+# Macenko reference H&E stain vectors and 99th percentile concentrations
+DEFAULT_MACENKO_REFERENCE = {
+    'stain_matrix': np.array([[0.5626, 0.7201, 0.4062],
+                              [0.2159, 0.8012, 0.5581]], dtype=np.float32),
+    'max_concentrations': np.array([1.9705, 1.0308], dtype=np.float32)
+}
+
+NORMALIZATION_METHODS = ('macenko', 'reinhard')
+
+def _to_rgb_uint8(optical_density, shape):
+    """Convert optical density (N, 3) back to an RGB uint8 image"""
+    rgb = 255.0 * np.power(10.0, -optical_density, dtype=np.float32)
+    return np.clip(rgb, 0, 255).astype(np.uint8).reshape(shape)
+
+def reinhard_statistics(rgb, background_threshold=0.15):
+    """Per-channel LAB mean and std over tissue pixels"""
+    lab = cv2.cvtColor(rgb.astype(np.float32) / 255.0, cv2.COLOR_RGB2LAB).reshape(-1, 3)
+    tissue = OD_LOOKUP[rgb].reshape(-1, 3).sum(axis=1) > background_threshold
+    if tissue.sum() < 100:
+        tissue = slice(None)
+    std = lab[tissue].std(axis=0)
+    return {
+        'mean': lab[tissue].mean(axis=0).astype(np.float32),
+        'std': np.maximum(std, 1e-6).astype(np.float32)
+    }
+
+def reinhard_normalize(rgb, source, target):
+    """Match the LAB mean and std of an image to a target"""
+    lab = cv2.cvtColor(rgb.astype(np.float32) / 255.0, cv2.COLOR_RGB2LAB)
+    lab = (lab - source['mean']) * (target['std'] / source['std']) + target['mean']
+    normalized = cv2.cvtColor(lab.astype(np.float32), cv2.COLOR_LAB2RGB)
+    return np.clip(normalized * 255.0, 0, 255).astype(np.uint8)
+
+def macenko_statistics(rgb, beta=0.15, alpha=1.0, max_pixels=100000):
+    """Estimate the H&E stain matrix and max concentrations of an image (Macenko et al.)"""
+    optical_density = OD_LOOKUP[rgb].reshape(-1, 3)
+    tissue = optical_density[(optical_density > beta).all(axis=1)]
+    if len(tissue) < 100:
+        raise ValueError("Not enough stained tissue to estimate stain vectors")
+    if len(tissue) > max_pixels:
+        # Subsampling keeps the eigen-decomposition cheap for large thumbnails
+        rows = np.random.default_rng(0).choice(len(tissue), size=max_pixels, replace=False)
+        tissue = tissue[rows]
+
+    eigenvalues, eigenvectors = np.linalg.eigh(np.cov(tissue.T))
+    plane = eigenvectors[:, 1:3]
+    projected = tissue @ plane
+    angles = np.arctan2(projected[:, 1], projected[:, 0])
+    min_angle, max_angle = np.percentile(angles, [alpha, 100 - alpha])
+
+    first = plane @ np.array([np.cos(min_angle), np.sin(min_angle)])
+    second = plane @ np.array([np.cos(max_angle), np.sin(max_angle)])
+    first *= np.sign(first.sum()) or 1.0
+    second *= np.sign(second.sum()) or 1.0
+
+    # Hematoxylin absorbs more red light than eosin
+    stain_matrix = np.array([first, second] if first[0] > second[0] else [second, first])
+    stain_matrix /= np.linalg.norm(stain_matrix, axis=1, keepdims=True)
+
+    concentrations = optical_density @ np.linalg.pinv(stain_matrix)
+    return {
+        'stain_matrix': stain_matrix.astype(np.float32),
+        'max_concentrations': np.percentile(concentrations, 99, axis=0).astype(np.float32)
+    }
+
+def macenko_normalize(rgb, source, target):
+    """Re-express an image's stain concentrations with the target stain matrix"""
+    optical_density = OD_LOOKUP[rgb].reshape(-1, 3)
+    concentrations = optical_density @ np.linalg.pinv(source['stain_matrix']).astype(np.float32)
+    scale = target['max_concentrations'] / np.maximum(source['max_concentrations'], 1e-6)
+    concentrations *= scale.astype(np.float32)
+    return _to_rgb_uint8(concentrations @ target['stain_matrix'], rgb.shape)
+
+class StainNormalizer:
+    """
+    Normalizes H&E stain appearance to a reference profile
+    Stain statistics for the reference and for each lab/scanner profile are
+    estimated once, saved under profile_dir and cached in memory
+    """
+
+    REFERENCE_PROFILE = 'reference'
+
+    def __init__(self, method='macenko', profile_dir='stain_profiles'):
+        """Initialize the normalization method and profile storage"""
+        if method not in NORMALIZATION_METHODS:
+            raise ValueError(f"Unknown stain normalization method: {method}")
+        self.method = method
+        self.profile_dir = profile_dir
+        self._profiles = {}
+        self._lock = threading.Lock()
+        self._estimate = macenko_statistics if method == 'macenko' else reinhard_statistics
+        self._apply = macenko_normalize if method == 'macenko' else reinhard_normalize
+
+    def _profile_path(self, name):
+        return os.path.join(self.profile_dir, f"{name}.{self.method}.npz")
+
+    def available_profiles(self):
+        """Names of the saved lab/scanner profiles for this method"""
+        if not os.path.isdir(self.profile_dir):
+            return []
+        suffix = f".{self.method}.npz"
+        return sorted(name[:-len(suffix)] for name in os.listdir(self.profile_dir)
+                      if name.endswith(suffix) and name[:-len(suffix)] != self.REFERENCE_PROFILE)
+
+    def estimate(self, rgb):
+        """Estimate stain statistics from an image or slide thumbnail"""
+        return self._estimate(rgb)
+
+    def fit_profile(self, name, rgb):
+        """Estimate and save the stain statistics of a lab/scanner (or the reference)"""
+        statistics = self.estimate(rgb)
+        os.makedirs(self.profile_dir, exist_ok=True)
+        np.savez(self._profile_path(name), **statistics)
+        with self._lock:
+            self._profiles[name] = statistics
+        logger.info("Stain profile '%s' saved for %s normalization", name, self.method)
+        return statistics
+
+    def get_profile(self, name):
+        """Return cached stain statistics for a profile, loading them from disk once"""
+        with self._lock:
+            if name in self._profiles:
+                return self._profiles[name]
+        path = self._profile_path(name)
+        if os.path.exists(path):
+            with np.load(path) as data:
+                statistics = {key: data[key] for key in data.files}
+        elif name == self.REFERENCE_PROFILE and self.method == 'macenko':
+            statistics = DEFAULT_MACENKO_REFERENCE
+        else:
+            raise KeyError(f"Stain profile '{name}' has not been fitted for {self.method}")
+        with self._lock:
+            self._profiles[name] = statistics
+        return statistics
+
+    def normalize(self, rgb, source_profile=None, source_statistics=None):
+        """Normalize an RGB uint8 image, estimating its stain only if no profile is given"""
+        if source_statistics is None:
+            if source_profile:
+                source_statistics = self.get_profile(source_profile)
+            else:
+                source_statistics = self.estimate(rgb)
+        return self._apply(rgb, source_statistics, self.get_profile(self.REFERENCE_PROFILE))
+
+    def normalize_tiles(self, tiles, thumbnail=None, source_profile=None):
+        """
+        Normalize a stream of tiles using one stain estimate from the slide thumbnail
+        For whole-slide callers; the conversion pipeline works on the 256x256
+        model input and uses normalize()
+        """
+        if source_profile:
+            source_statistics = self.get_profile(source_profile)
+        elif thumbnail is not None:
+            source_statistics = self.estimate(thumbnail)
+        else:
+            raise ValueError("Tiled normalization needs a thumbnail or a source profile")
+        target = self.get_profile(self.REFERENCE_PROFILE)
+        for tile in tiles:
+            yield self._apply(tile, source_statistics, target)
@@ -0,0 +1,172 @@
+import os
+import re
+import time
+import hashlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Files are named "<session_id>_<name>" or "report_<session_id>.pdf"
+SESSION_FILENAME_PATTERN = re.compile(r'^(?:report_)?([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})')
+
+# Two levels of two hex characters give 65,536 leaf directories
+SHARD_DEPTH = 2
+SHARD_WIDTH = 2
+
+def session_key(filename):
+    """Return the session ID a stored file belongs to, or None"""
+    match = SESSION_FILENAME_PATTERN.match(os.path.basename(filename))
+    return match.group(1) if match else None
+
+def shard_dir(folder, filename):
+    """Return the shard directory for a file, derived from its session ID"""
+    key = session_key(filename)
+    if key is None:
+        # Fall back to a content-independent hash so unknown names still spread out
+        key = hashlib.sha1(os.path.basename(filename).encode('utf-8')).hexdigest()
+    key = key.replace('-', '')
+    parts = [key[i * SHARD_WIDTH:(i + 1) * SHARD_WIDTH] for i in range(SHARD_DEPTH)]
+    return os.path.join(folder, *parts)
+
+def shard_path(folder, filename, create=True):
+    """Return the sharded location for a new file, creating its directory"""
+    directory = shard_dir(folder, filename)
+    if create:
+        os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, os.path.basename(filename))
+
+def resolve_path(folder, filename):
+    """Locate a stored file, checking the sharded layout before the legacy flat one"""
+    filename = os.path.basename(filename)
+    sharded = shard_path(folder, filename, create=False)
+    if os.path.exists(sharded):
+        return sharded
+    return os.path.join(folder, filename)
+
+def iter_stored_files(folder):
+    """Yield every regular file below a storage folder"""
+    for root, dirs, files in os.walk(folder):
+        for name in files:
+            if name.startswith('.'):
+                continue
+            yield os.path.join(root, name)
+
+def migrate_flat_layout(folder, dry_run=False):
+    """Move files from the flat top-level folder into their shard directories"""
+    moved = {}
+    for entry in os.scandir(folder):
+        if not entry.is_file() or entry.name.startswith('.'):
+            continue
+        target = shard_path(folder, entry.name, create=not dry_run)
+        if not dry_run:
+            os.replace(entry.path, target)
+        moved[entry.path] = target
+    logger.info("Migrated %s files in %s to sharded layout", len(moved), folder)
+    return moved
+
+def file_digest(path, chunk_size=1024 * 1024):
+    """Compute the SHA-256 of a file without reading it into memory at once"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as handle:
+        for chunk in iter(lambda: handle.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def preview_path(path):
+    """Location of the JPEG preview written next to a generated master image"""
+    return f"{os.path.splitext(path)[0]}_preview.jpg"
+
+def find_orphans(folders, known_session_ids, min_age_seconds=3600, now=None):
+    """
+    Return stored files whose session no longer exists
+    Files younger than min_age_seconds are kept: uploads and batch imports
+    are written before their session row is committed
+    """
+    now = now or time.time()
+    orphans = []
+    for folder in folders:
+        for path in iter_stored_files(folder):
+            key = session_key(path)
+            # Files not named after a session are never treated as orphans
+            if key is None or key in known_session_ids:
+                continue
+            try:
+                if now - os.path.getmtime(path) < min_age_seconds:
+                    continue
+            except FileNotFoundError:
+                continue
+            orphans.append(path)
+    return orphans
+
+def find_expired_reports(folder, max_age_seconds, now=None):
+    """Return cached report PDFs older than the given age"""
+    now = now or time.time()
+    expired = []
+    for path in iter_stored_files(folder):
+        name = os.path.basename(path)
+        if name.startswith('report_') and name.endswith('.pdf'):
+            if now - os.path.getmtime(path) > max_age_seconds:
+                expired.append(path)
+    return expired
+
+def hardlink_duplicates(folders, dry_run=False):
+    """Replace files with identical content by hard links to one copy"""
+    by_size = {}
+    for folder in folders:
+        for path in iter_stored_files(folder):
+            by_size.setdefault(os.path.getsize(path), []).append(path)
+
+    linked = []
+    for size, paths in by_size.items():
+        # Only files sharing a size can share content; skip hashing the rest
+        if len(paths) < 2 or size == 0:
+            continue
+        by_digest = {}
+        for path in paths:
+            by_digest.setdefault(file_digest(path), []).append(path)
+        for duplicates in by_digest.values():
+            original = duplicates[0]
+            original_inode = os.stat(original).st_ino
+            for path in duplicates[1:]:
+                if os.stat(path).st_ino == original_inode:
+                    continue
+                if not dry_run:
+                    temp_path = f"{path}.link"
+                    os.link(original, temp_path)
+                    os.replace(temp_path, path)
+                linked.append(path)
+    return linked
+
+def collect_garbage(upload_folder, generated_folder, known_session_ids,
+                    report_max_age_seconds=24 * 3600, orphan_min_age_seconds=3600, dry_run=False):
+    """Delete orphaned files, expire cached PDFs and hard-link duplicate content"""
+    folders = [upload_folder, generated_folder]
+
+    orphans = find_orphans(folders, known_session_ids, min_age_seconds=orphan_min_age_seconds)
+    orphan_set = set(orphans)
+    expired = [path for path in find_expired_reports(generated_folder, report_max_age_seconds)
+               if path not in orphan_set]
+
+    for path in orphans + expired:
+        if not dry_run:
+            os.remove(path)
+
+    linked = hardlink_duplicates(folders, dry_run=dry_run)
+
+    if not dry_run:
+        _remove_empty_dirs(folders)
+
+    logger.info("Storage GC: %s orphans, %s expired reports, %s duplicates linked",
+                len(orphans), len(expired), len(linked))
+    return {
+        'orphans': orphans,
+        'expired_reports': expired,
+        'linked_duplicates': linked
+    }
+
+def _remove_empty_dirs(folders):
+    """Remove shard directories left empty after deletions"""
+    for folder in folders:
+        for root, dirs, files in os.walk(folder, topdown=False):
+            if root != folder and not os.listdir(root):
+                os.rmdir(root)
@@ -1,12 +1,11 @@
 import os
 import io
-from reportlab.lib.pagesizes import letter, A4
-from reportlab.lib import colors
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle, Image
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.lib.units import inch
 from datetime import datetime
+from flask import current_app
 import logging
+import storage
+
+logger = logging.getLogger(__name__)
 
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'tiff', 'tif'}
 
@@ -19,18 +18,25 @@ def process_image(image_path):
     """General image processing utilities"""
     try:
         # Add any common image processing steps here
-        logging.info(f"Processing image: {image_path}")
+        logger.info("Processing image: %s", image_path)
         return True
     except Exception as e:
-        logging.error(f"Image processing failed: {str(e)}")
+        logger.error("Image processing failed: %s", e)
         return False
 
 def generate_report_pdf(session, report):
     """Generate PDF diagnostic report"""
+    # ReportLab is only needed here, so it is not imported at startup
+    from reportlab.lib.pagesizes import A4
+    from reportlab.lib import colors
+    from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle, Image
+    from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+    from reportlab.lib.units import inch
+    
     try:
         # Create PDF file path
         pdf_filename = f"report_{session.session_id}.pdf"
-        pdf_path = os.path.join('generated', pdf_filename)
+        pdf_path = storage.shard_path(current_app.config['GENERATED_FOLDER'], pdf_filename)
         
         # Create PDF document
         doc = SimpleDocTemplate(pdf_path, pagesize=A4)
@@ -109,6 +115,36 @@ def generate_report_pdf(session, report):
         story.append(results_table)
         story.append(Spacer(1, 20))
         
+        # Marker Panel (if analysed)
+        marker_results = session.current_marker_results()
+        if marker_results:
+            story.append(Paragraph("Marker Panel", heading_style))
+            
+            panel_data = [['Marker', 'Status', 'Positive Cells', 'Intensity', 'Confidence']]
+            for marker in marker_results:
+                panel_data.append([
+                    marker.marker,
+                    marker.status or 'Not determined',
+                    f"{marker.percentage:.1f}%" if marker.percentage is not None else 'N/A',
+                    marker.staining_intensity or 'Not assessed',
+                    f"{marker.confidence_score:.1%}" if marker.confidence_score is not None else 'N/A'
+                ])
+            
+            panel_table = Table(panel_data, colWidths=[1*inch, 1.2*inch, 1.1*inch, 1*inch, 1*inch])
+            panel_table.setStyle(TableStyle([
+                ('BACKGROUND', (0, 0), (-1, 0), colors.lightblue),
+                ('TEXTCOLOR', (0, 0), (-1, -1), colors.black),
+                ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
+                ('FONTNAME', (0, 0), (-1, -1), 'Helvetica'),
+                ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+                ('FONTSIZE', (0, 0), (-1, -1), 10),
+                ('BOTTOMPADDING', (0, 0), (-1, -1), 6),
+                ('GRID', (0, 0), (-1, -1), 1, colors.black)
+            ]))
+            
+            story.append(panel_table)
+            story.append(Spacer(1, 20))
+        
         # Quantitative Analysis (if available)
         if report and report.positive_cell_count:
             story.append(Paragraph("Quantitative Analysis", heading_style))
@@ -134,6 +170,18 @@ def generate_report_pdf(session, report):
             story.append(quant_table)
             story.append(Spacer(1, 20))
         
+        # HER2 Heatmap (if generated)
+        if session.heatmap_image_path and os.path.exists(session.heatmap_image_path):
+            story.append(Paragraph("HER2 Score Heatmap", heading_style))
+            heatmap_image = Image(session.heatmap_image_path)
+            # Fit the thumbnail into a 3 inch box, keeping its aspect ratio
+            scale = 3 * inch / max(heatmap_image.imageWidth, heatmap_image.imageHeight)
+            heatmap_image.drawWidth = heatmap_image.imageWidth * scale
+            heatmap_image.drawHeight = heatmap_image.imageHeight * scale
+            story.append(heatmap_image)
+            story.append(Paragraph("Per-tile HER2 score, blue (low) to red (high)", styles['Italic']))
+            story.append(Spacer(1, 20))
+        
         # Summary
         if report and report.summary:
             story.append(Paragraph("Summary", heading_style))
@@ -169,11 +217,11 @@ def generate_report_pdf(session, report):
         # Build PDF
         doc.build(story)
         
-        logging.info(f"PDF report generated: {pdf_path}")
+        logger.info("PDF report generated: %s", pdf_path)
         return pdf_path
         
     except Exception as e:
-        logging.error(f"PDF generation failed: {str(e)}")
+        logger.error("PDF generation failed: %s", e)
         raise
 
 def format_confidence(confidence):
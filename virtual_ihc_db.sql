@@ -29,11 +29,16 @@ CREATE TABLE IF NOT EXISTS analysis_session (
     original_filename VARCHAR(255) NOT NULL,
     he_image_path VARCHAR(500) NOT NULL,
     ihc_image_path VARCHAR(500),
+    heatmap_image_path VARCHAR(500),
     her2_prediction VARCHAR(20),
     confidence_score FLOAT,
     cancer_grade VARCHAR(10),
     biomarker_percentage FLOAT,
     staining_intensity VARCHAR(20),
+    tta_agreement FLOAT,
+    memory_estimate BIGINT,
+    converter_version VARCHAR(50),
+    classifier_version VARCHAR(50),
     processing_status VARCHAR(20) DEFAULT 'uploaded',
     error_message TEXT,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
@@ -56,6 +61,94 @@ CREATE TABLE IF NOT EXISTS report_data (
     FOREIGN KEY (session_id) REFERENCES analysis_session(session_id) ON DELETE CASCADE
 );
 
+-- Upgrade existing installations (MariaDB syntax, as shipped with XAMPP)
+ALTER TABLE analysis_session ADD COLUMN IF NOT EXISTS converter_version VARCHAR(50);
+ALTER TABLE analysis_session ADD COLUMN IF NOT EXISTS classifier_version VARCHAR(50);
+ALTER TABLE analysis_session ADD COLUMN IF NOT EXISTS tta_agreement FLOAT;
+ALTER TABLE analysis_session ADD COLUMN IF NOT EXISTS heatmap_image_path VARCHAR(500);
+ALTER TABLE analysis_session ADD COLUMN IF NOT EXISTS memory_estimate BIGINT;
+
+-- Phase 2 results per classifier version
+CREATE TABLE IF NOT EXISTS classification_result (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    session_id VARCHAR(64) NOT NULL,
+    classifier_version VARCHAR(50) NOT NULL,
+    her2_prediction VARCHAR(20),
+    confidence_score FLOAT,
+    cancer_grade VARCHAR(10),
+    biomarker_percentage FLOAT,
+    staining_intensity VARCHAR(20),
+    tta_agreement FLOAT,
+    positive_cell_count INT,
+    total_cell_count INT,
+    stained_area_percentage FLOAT,
+    report_summary TEXT,
+    report_recommendations TEXT,
+    report_technical_notes TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    CONSTRAINT uq_result_session_version UNIQUE (session_id, classifier_version),
+    FOREIGN KEY (session_id) REFERENCES analysis_session(session_id) ON DELETE CASCADE
+);
+
+-- Upgrade tables created before test-time augmentation and per-version report text
+ALTER TABLE classification_result ADD COLUMN IF NOT EXISTS tta_agreement FLOAT;
+ALTER TABLE classification_result ADD COLUMN IF NOT EXISTS report_summary TEXT;
+ALTER TABLE classification_result ADD COLUMN IF NOT EXISTS report_recommendations TEXT;
+ALTER TABLE classification_result ADD COLUMN IF NOT EXISTS report_technical_notes TEXT;
+
+-- Per-marker results of multi-marker panel analyses (HER2, ER, PR, Ki-67)
+CREATE TABLE IF NOT EXISTS marker_result (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    session_id VARCHAR(64) NOT NULL,
+    classifier_version VARCHAR(50) NOT NULL,
+    marker VARCHAR(20) NOT NULL,
+    status VARCHAR(20),
+    percentage FLOAT,
+    confidence_score FLOAT,
+    staining_intensity VARCHAR(20),
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    CONSTRAINT uq_marker_session_version UNIQUE (session_id, classifier_version, marker),
+    FOREIGN KEY (session_id) REFERENCES analysis_session(session_id) ON DELETE CASCADE
+);
+
+-- Peak memory per pipeline stage of a session
+CREATE TABLE IF NOT EXISTS stage_memory (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    session_id VARCHAR(64) NOT NULL,
+    stage VARCHAR(30) NOT NULL,
+    seconds FLOAT,
+    rss_start BIGINT,
+    rss_peak BIGINT,
+    traced_peak BIGINT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (session_id) REFERENCES analysis_session(session_id) ON DELETE CASCADE
+);
+
+-- Feature vectors per session (float32 blob, see features.FEATURE_NAMES)
+CREATE TABLE IF NOT EXISTS session_features (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    session_id VARCHAR(64) NOT NULL UNIQUE,
+    feature_version VARCHAR(50) NOT NULL,
+    dimension INT NOT NULL,
+    vector BLOB NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (session_id) REFERENCES analysis_session(session_id) ON DELETE CASCADE
+);
+
+-- Bulk re-classification progress
+CREATE TABLE IF NOT EXISTS reclassification_job (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    classifier_version VARCHAR(50) NOT NULL,
+    status VARCHAR(20) DEFAULT 'running',
+    total_sessions INT DEFAULT 0,
+    processed_sessions INT DEFAULT 0,
+    failed_sessions INT DEFAULT 0,
+    last_session_pk INT DEFAULT 0,
+    started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP NULL,
+    finished_at TIMESTAMP NULL
+);
+
 -- Create indexes for better performance
 CREATE INDEX idx_user_username ON user(username);
 CREATE INDEX idx_user_email ON user(email);
@@ -63,6 +156,7 @@ CREATE INDEX idx_session_user ON analysis_session(user_id);
 CREATE INDEX idx_session_status ON analysis_session(processing_status);
 CREATE INDEX idx_session_created ON analysis_session(created_at);
 CREATE INDEX idx_report_session ON report_data(session_id);
+CREATE INDEX idx_session_classifier_version ON analysis_session(classifier_version);
 
 -- Insert sample admin user (password: admin123)
 -- Note: In production, use stronger passwords